@@ -0,0 +1,11 @@
+from django.conf.urls import url
+
+from tinyforum import async_views
+
+app_name = "tinyforum-async"
+urlpatterns = [
+    url(r"^$", async_views.thread_list, name="thread-list"),
+    url(r"^(?P<pk>[0-9]+)/$", async_views.post_list, name="thread-detail"),
+    url(r"^(?P<pk>[0-9]+)/star/$", async_views.thread_star, name="thread-star"),
+    url(r"^(?P<pk>[0-9]+)/sync/$", async_views.post_sync, name="post-sync"),
+]
@@ -38,6 +38,10 @@ urlpatterns = [
         login_required(add_is_moderator(views.thread_form)),
         name="thread-create",
     ),
+    url(r"^search/$", views.search, name="search"),
+    # Prometheus metrics if TINYFORUM_METRICS is enabled, for staff users
+    # and scrapers sending the bearer token TINYFORUM_METRICS_TOKEN
+    url(r"^metrics/$", views.metrics, name="metrics"),
     url(r"^(?P<pk>[0-9]+)/$", views.post_list, name="thread-detail"),
     url(
         r"^(?P<pk>[0-9]+)/update/$",
@@ -45,6 +49,7 @@ urlpatterns = [
         name="thread-update",
     ),
     url(r"^(?P<pk>[0-9]+)/star/$", views.thread_star, name="thread-star"),
+    url(r"^(?P<pk>[0-9]+)/sync/$", views.post_sync, name="post-sync"),
     url(
         r"^post/(?P<pk>[0-9]+)/update/$",
         login_required(add_is_moderator(views.post_form)),
@@ -55,7 +60,33 @@ urlpatterns = [
         login_required(views.post_report),
         name="post-report",
     ),
+    url(r"^export/$", login_required(views.export), name="export"),
     url(r"^moderation/$", moderator_required(views.report_list), name="report-list"),
+    url(
+        r"^moderation/queue/$",
+        moderator_required(views.report_queue),
+        name="report-queue",
+    ),
+    url(
+        r"^moderation/post/(?P<pk>[0-9]+)/$",
+        moderator_required(views.report_post_handle),
+        name="report-post-handle",
+    ),
+    url(
+        r"^moderation/claim/$",
+        moderator_required(views.report_claim),
+        name="report-claim",
+    ),
+    url(
+        r"^moderation/bulk/$",
+        moderator_required(views.report_bulk_handle),
+        name="report-bulk-handle",
+    ),
+    url(
+        r"^moderation/export/$",
+        moderator_required(views.export_forum),
+        name="export-forum",
+    ),
     url(
         r"^moderation/(?P<pk>[0-9]+)/$",
         moderator_required(views.report_handle),
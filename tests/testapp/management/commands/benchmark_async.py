@@ -0,0 +1,78 @@
+import asyncio
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.test import AsyncClient, override_settings
+
+from tinyforum.models import Post, Thread
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the sync and the async read views under concurrent clients."
+        " Requires a file based database, e.g. --settings pointing to a copy"
+        " of testapp.settings using a SQLite file."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--clients", type=int, default=20)
+        parser.add_argument("--requests", type=int, default=10)
+        parser.add_argument(
+            "--latency",
+            type=float,
+            default=0.005,
+            help="Seconds added to every query to simulate a database server.",
+        )
+
+    @override_settings(ALLOWED_HOSTS=["testserver"])
+    def handle(self, **options):
+        if connection.vendor == "sqlite" and connection.is_in_memory_db():
+            raise CommandError("In-memory databases are not shared between threads.")
+
+        def latency(execute, sql, params, many, context):
+            time.sleep(options["latency"])
+            return execute(sql, params, many, context)
+
+        def add_latency(connection, **kwargs):
+            if latency not in connection.execute_wrappers:
+                connection.execute_wrappers.append(latency)
+
+        user, _ = User.objects.get_or_create(username="benchmark-author")
+        thread = Thread.objects.create(title="Benchmark", authored_by=user)
+        Post.objects.bulk_create(
+            [
+                Post(thread=thread, authored_by=user, text="Post %s" % i)
+                for i in range(50)
+            ]
+        )
+        Thread.objects.filter(pk=thread.pk).recount()
+
+        connection.close()
+        connection_created.connect(add_latency)
+        try:
+            for name, prefix in [("sync", "/"), ("async", "/async/")]:
+                seconds = asyncio.run(self.run(prefix, thread, options))
+                total = options["clients"] * options["requests"]
+                self.stdout.write(
+                    "%s: %.1f requests/s (%s clients, %s requests)"
+                    % (name, total / seconds, options["clients"], total)
+                )
+        finally:
+            connection_created.disconnect(add_latency)
+            thread.delete()
+
+    async def run(self, prefix, thread, options):
+        urls = [prefix, "%s%s/" % (prefix, thread.pk)]
+
+        async def client():
+            c = AsyncClient()
+            for i in range(options["requests"]):
+                response = await c.get(urls[i % 2])
+                assert response.status_code == 200, response
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client() for i in range(options["clients"])))
+        return time.perf_counter() - start
@@ -0,0 +1,133 @@
+import json
+import platform
+import statistics
+import time
+
+import django
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client, override_settings
+from django.urls import reverse
+
+import tinyforum
+from tinyforum.models import Post, PostReport, Thread
+
+
+class Command(BaseCommand):
+    help = (
+        "Time the forum views against the current database and write the"
+        " results as JSON. Generate a dataset using tinyforum_generate first."
+        " Changes are rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--repeat", type=int, default=20)
+        parser.add_argument("--output", help="Write the JSON to this file.")
+
+    @override_settings(ALLOWED_HOSTS=["testserver"])
+    def handle(self, **options):
+        thread = (
+            Thread.objects.active().order_by("-post_count").only("pk", "post_count")
+        ).first()
+        if thread is None:
+            raise CommandError("No threads found, run tinyforum_generate first.")
+
+        dataset = {
+            "users": User.objects.count(),
+            "threads": Thread.objects.count(),
+            "posts": Post.objects.count(),
+            "stars": Thread.starred_by.through.objects.count(),
+            "reports": PostReport.objects.filter(handled_at__isnull=True).count(),
+            "largest_thread": thread.post_count,
+        }
+
+        with transaction.atomic():
+            results = self.run_benchmarks(thread, options["repeat"])
+            transaction.set_rollback(True)
+
+        data = json.dumps(
+            {
+                "tinyforum": tinyforum.__version__,
+                "django": django.get_version(),
+                "python": platform.python_version(),
+                "database": connection.vendor,
+                "repeat": options["repeat"],
+                "dataset": dataset,
+                "results": results,
+            },
+            indent=2,
+        )
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(data)
+        else:
+            self.stdout.write(data)
+
+    def run_benchmarks(self, thread, repeat):
+        user = User.objects.create(username="benchmark-moderator", is_staff=True)
+        client = Client()
+        client.force_login(user)
+
+        url = reverse("tinyforum:thread-detail", kwargs={"pk": thread.pk})
+        deep = thread.post_count // 40 + 1
+        reported = list(
+            Post.objects.reported().order_by("pk").values_list("pk", flat=True)
+        )
+        star_status = [0]
+
+        def star():
+            star_status[0] = 1 - star_status[0]
+            return client.get(
+                reverse("tinyforum:thread-star", kwargs={"pk": thread.pk}),
+                {"status": star_status[0]},
+            )
+
+        def moderate():
+            if not reported:
+                return None
+            return client.post(
+                reverse("tinyforum:report-post-handle", kwargs={"pk": reported.pop()}),
+                {"moderation_status": Post.HIDDEN},
+            )
+
+        benchmarks = [
+            ("thread_list", lambda: client.get(reverse("tinyforum:thread-list"))),
+            ("post_list_first", lambda: client.get(url)),
+            ("post_list_deep", lambda: client.get(url, {"page": deep})),
+            ("post_list_last", lambda: client.get(url, {"page": "last"})),
+            ("post_create", lambda: client.post(url, {"text": "<p>Benchmark</p>"})),
+            ("thread_star", star),
+            ("moderation", moderate),
+        ]
+
+        results = {}
+        for name, fn in benchmarks:
+            # Warm up caches and record the number of queries once. Test
+            # client requests reset connection.queries, count using a wrapper.
+            queries = []
+            with connection.execute_wrapper(
+                lambda execute, *args: queries.append(args[0]) or execute(*args)
+            ):
+                response = fn()
+            if response is not None and response.status_code >= 400:
+                raise CommandError(
+                    "%s failed with status %s" % (name, response.status_code)
+                )
+            timings = []
+            for _i in range(repeat):
+                start = time.perf_counter()
+                if fn() is None:
+                    break
+                timings.append(1000 * (time.perf_counter() - start))
+            if not timings:
+                continue
+            results[name] = {
+                "queries": len(queries),
+                "runs": len(timings),
+                "min_ms": round(min(timings), 3),
+                "median_ms": round(statistics.median(timings), 3),
+                "mean_ms": round(statistics.mean(timings), 3),
+                "max_ms": round(max(timings), 3),
+            }
+        return results
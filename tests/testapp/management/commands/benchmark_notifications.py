@@ -0,0 +1,48 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from tinyforum.models import Notification, Post, Thread
+
+
+class Command(BaseCommand):
+    help = "Measure the notification fan-out for a thread with many stars."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--stars", type=int, default=10000)
+        parser.add_argument("--posts", type=int, default=50)
+
+    @transaction.atomic
+    def handle(self, **options):
+        author = User.objects.create(username="benchmark-author")
+        User.objects.bulk_create(
+            [User(username="benchmark-%s" % i) for i in range(options["stars"])],
+            batch_size=1000,
+        )
+        thread = Thread.objects.create(title="Hot thread", authored_by=author)
+        Thread.starred_by.through.objects.bulk_create(
+            [
+                Thread.starred_by.through(thread=thread, user_id=pk)
+                for pk in User.objects.filter(
+                    username__startswith="benchmark-"
+                ).values_list("pk", flat=True)
+            ],
+            batch_size=1000,
+        )
+
+        for i in range(options["posts"]):
+            post = Post.objects.create(
+                thread=thread, authored_by=author, text="Post %s" % i
+            )
+            start = time.perf_counter()
+            Notification.objects.notify(post)
+            seconds = time.perf_counter() - start
+            if i < 2 or i == options["posts"] - 1:
+                self.stdout.write(
+                    "Post %s: %.1f ms, %s pending notifications"
+                    % (i, 1000 * seconds, Notification.objects.pending().count())
+                )
+
+        transaction.set_rollback(True)
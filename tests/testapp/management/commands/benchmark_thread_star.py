@@ -0,0 +1,76 @@
+import timeit
+from types import SimpleNamespace
+
+from django import template
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.template import Context, Engine, Template
+from django.template.loader import render_to_string
+
+from tinyforum.cache import set_thread_starred, starred_thread_ids
+from tinyforum.models import Thread
+
+# Template library containing the thread_star tag as it was before it reused
+# the template and the context for all rows
+register = template.Library()
+
+
+@register.simple_tag(takes_context=True)
+def thread_star(context, thread):
+    user = context["request"].user
+    if not user.is_authenticated:
+        return ""
+
+    # Look up the status of all threads in the current page at once
+    status = context.render_context.setdefault("tinyforum_starred", {})
+    if thread.id not in status:
+        ids = {
+            obj.id for obj in context.get("object_list", ()) if isinstance(obj, Thread)
+        }
+        ids.add(thread.id)
+        starred = starred_thread_ids(user, ids)
+        status.update((id, id in starred) for id in ids)
+
+    return render_to_string(
+        "tinyforum/thread_star.html", {"thread": thread, "status": status[thread.id]}
+    )
+
+
+class Command(BaseCommand):
+    help = "Compare the rendering cost of thread_star for a page of threads."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=50)
+        parser.add_argument("--repeat", type=int, default=200)
+
+    def handle(self, **options):
+        user = User(pk=1, username="bench")
+        threads = [Thread(pk=i, title="Thread %s" % i) for i in range(options["rows"])]
+        for thread in threads:
+            set_thread_starred(user, thread.pk, thread.pk % 2)
+        context = {
+            "request": SimpleNamespace(user=user),
+            "object_list": threads,
+        }
+
+        engine = Engine(
+            libraries=dict(Engine.get_default().libraries, tinyforum_previous=__name__)
+        )
+
+        def render(library):
+            template = Template(
+                "{%% load %s %%}{%% for thread in object_list %%}"
+                "{%% thread_star thread %%}{%% endfor %%}" % library,
+                engine=engine,
+            )
+            return lambda: template.render(Context(context))
+
+        for name, fn in [
+            ("previous thread_star", render("tinyforum_previous")),
+            ("thread_star", render("tinyforum")),
+        ]:
+            seconds = timeit.timeit(fn, number=options["repeat"])
+            self.stdout.write(
+                "%s: %.3f ms per page of %s rows"
+                % (name, 1000 * seconds / options["repeat"], options["rows"])
+            )
@@ -0,0 +1,140 @@
+import asyncio
+import json
+from unittest import skipUnless
+
+import django
+from django.contrib.auth.models import User
+from django.test import TransactionTestCase, override_settings
+
+from tinyforum.live import LocalBroker, get_broker, live_events
+from tinyforum.models import Post, Thread
+
+if django.VERSION >= (3, 1):
+    from asgiref.sync import sync_to_async
+    from django.test import AsyncClient
+
+
+@skipUnless(django.VERSION >= (3, 1), "Async tests require Django 3.1")
+class AsyncViewTests(TransactionTestCase):
+    # The async views use connections in other threads, data has to be
+    # committed to be visible there
+
+    async def test_async_views(self):
+        @sync_to_async
+        def setup():
+            user = User.objects.create_user("user1", "user1@example.com", "user1")
+            t = Thread.objects.create(title="One", authored_by=user)
+            Post.objects.create(thread=t, text="First", authored_by=user)
+            return user, t
+
+        user, t = await setup()
+
+        c = AsyncClient()
+        response = await c.get("/async/")
+        self.assertContains(response, "One")
+        response = await c.get("/async/%s/" % t.pk)
+        self.assertContains(response, "First")
+        response = await c.get("/async/%s/" % (t.pk + 1))
+        self.assertEqual(response.status_code, 404)
+        response = await c.get("/async/%s/star/?status=1" % t.pk)
+        self.assertEqual(response.status_code, 403)
+
+        # Waiting for new posts does not block the thread serving sync views
+        url = "/async/%s/sync/" % t.pk
+        url += "?wait=5&after=%s" % (await c.get(url)).json()["after"]
+        with override_settings(TINYFORUM_SYNC_INTERVAL=0.01, TINYFORUM_SYNC_MAX_WAIT=5):
+            waiting = asyncio.ensure_future(c.get(url))
+            await asyncio.sleep(0.05)
+            self.assertFalse(waiting.done())
+            post = await sync_to_async(Post.objects.create)(
+                thread=t, text="Second", authored_by=user
+            )
+            response = await waiting
+        self.assertEqual([p["id"] for p in response.json()["posts"]], [post.pk])
+
+    async def test_live_events(self):
+        @sync_to_async
+        def setup():
+            user = User.objects.create_user("user1", "user1@example.com", "user1")
+            t = Thread.objects.create(title="One", authored_by=user)
+            post = Post.objects.create(thread=t, text="First", authored_by=user)
+            return user, t, post
+
+        user, t, post = await setup()
+
+        async def django_app(scope, receive, send):
+            await send({"type": "http.response.start", "status": 204})
+
+        app = live_events(django_app, prefix="/forum/")
+        disconnected = asyncio.Event()
+        messages = asyncio.Queue()
+
+        async def receive():
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        async def request(path):
+            await app({"type": "http", "path": path}, receive, messages.put)
+
+        async def events():
+            while True:
+                message = await messages.get()
+                body = message.get("body", b"")
+                if body and not body.startswith(b":"):
+                    return body.decode("utf-8")
+
+        await request("/forum/")
+        self.assertEqual((await messages.get())["status"], 204)
+        await request("/forum/%s/events/" % (t.pk + 1))
+        self.assertEqual((await messages.get())["status"], 404)
+        await messages.get()
+
+        with override_settings(TINYFORUM_LIVE_KEEPALIVE=0.01):
+            task = asyncio.ensure_future(request("/forum/%s/events/" % t.pk))
+            self.assertEqual((await messages.get())["status"], 200)
+            while not get_broker().has_subscribers(t.pk):
+                await asyncio.sleep(0.01)
+            self.assertEqual((await messages.get())["body"], b": keepalive\n\n")
+
+            @sync_to_async
+            def changes():
+                second = Post.objects.create(thread=t, text="Second", authored_by=user)
+                post.text = "Edited"
+                post.save()
+                Post.objects.create(
+                    thread=t, text="Spam", authored_by=user, moderation_status="hidden"
+                )
+                post.moderation_status = "hidden"
+                post.save()
+                Post.objects.filter(pk=second.pk).moderate("hidden")
+                return second
+
+            second = await changes()
+            event = await events()
+            self.assertTrue(event.startswith("event: post\ndata: {"))
+            self.assertEqual(json.loads(event.split("data: ")[1])["text"], "Second")
+            self.assertIn('"text": "Edited"', await events())
+            self.assertEqual(
+                await events(),
+                'event: hide\ndata: {"type": "hide", "id": %s}\n\n' % post.pk,
+            )
+            self.assertIn('"id": %s' % second.pk, await events())
+
+            disconnected.set()
+            await task
+        self.assertFalse(get_broker().has_subscribers(t.pk))
+
+    async def test_local_broker(self):
+        broker = LocalBroker(maxsize=1)
+        queue = broker.subscribe(1)
+        broker.publish(1, "a")
+        broker.publish(1, "b")
+        broker.publish(2, "c")
+        await asyncio.sleep(0)
+        self.assertEqual(queue.qsize(), 1)
+        self.assertEqual(await queue.get(), "a")
+        other = broker.subscribe(1)
+        broker.unsubscribe(1, queue)
+        self.assertTrue(broker.has_subscribers(1))
+        broker.unsubscribe(1, other)
+        self.assertFalse(broker.has_subscribers(1))
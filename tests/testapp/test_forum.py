@@ -1,12 +1,58 @@
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import zipfile
+from datetime import timedelta
 from types import SimpleNamespace
+from unittest import mock, skipUnless
+from urllib.parse import urlencode
 
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser, User
 from django.contrib.messages import get_messages
-from django.test import Client, TestCase
+from django.core.management import CommandError, call_command
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection
+from django.db.models import Q
+from django.http import HttpResponse, HttpResponseRedirect
+from django.test import Client, TestCase, override_settings
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.html import escape
 
+from tinyforum.cache import GENERATION_VERSION_KEY, cache_anonymous_page, get_cache
 from tinyforum.forms import form_for_post, form_for_thread
-from tinyforum.models import Post, PostReport, Thread
+from tinyforum.management.commands.tinyforum_import import (
+    Command as ImportCommand,
+)
+from tinyforum.metrics import prometheus_text, record, reset
+from tinyforum.models import (
+    Notification,
+    OutboxEvent,
+    Post,
+    PostReport,
+    ReadMarker,
+    Thread,
+)
+from tinyforum.outbox import send
+from tinyforum.search import (
+    PostgreSQLBackend,
+    get_backend,
+    index_threads,
+    post_matches,
+    thread_matches,
+)
+from tinyforum.signals import (
+    operation_measured,
+    post_created,
+    post_report_handled,
+    post_reports_handled,
+)
+from tinyforum.utils import KeysetPaginator, paginate_list
 
 
 def messages(response):
@@ -23,6 +69,9 @@ class ForumTests(TestCase):
         cls.user1 = User.objects.create_user("user1", "user1@example.com", "password")
         cls.user2 = User.objects.create_user("user2", "user2@example.com", "password")
 
+    def setUp(self):
+        get_cache().clear()
+
     def test_posting_a_bit(self):
         c = Client()
         c.force_login(self.user1)
@@ -82,12 +131,18 @@ class ForumTests(TestCase):
         self.assertContains(response, 'href="/%s/?page=last"' % thread.pk)
 
     def test_thread_list(self):
-        Thread.objects.create(title="One", authored_by=self.user1)
+        t = Thread.objects.create(title="One", authored_by=self.user1)
         Thread.objects.create(title="Two", authored_by=self.user1)
+        Post.objects.create(thread=t, text="One", authored_by=self.user2)
 
         c = Client()
         response = c.get("/")
         self.assertContains(response, "data-set-status", 0)
+        self.assertEqual(
+            [thread.title for thread in response.context["object_list"]],
+            ["One", "Two"],
+        )
+        self.assertContains(response, "Latest post by user2")
 
         c.force_login(self.user2)
         response = c.get("/")
@@ -277,6 +332,63 @@ class ForumTests(TestCase):
         self.assertContains(response, '"status": 0')
         self.assertEqual(t.starred_by.count(), 0)
 
+    def test_thread_star_lookup(self):
+        threads = [
+            Thread.objects.create(title="Thread %s" % i, authored_by=self.user1)
+            for i in range(5)
+        ]
+        threads[1].starred_by.add(self.user2)
+        threads[3].starred_by.add(self.user2)
+
+        c = Client()
+        c.force_login(self.user2)
+        with self.assertNumQueries(5):
+            # Session, user, count, threads, stars of the current page
+            response = c.get("/")
+        self.assertContains(response, "checked", 2)
+
+        with self.assertNumQueries(4):
+            # Stars are cached now
+            response = c.get("/")
+        self.assertContains(response, "checked", 2)
+
+        # The star view updates the cache
+        url = reverse("tinyforum:thread-star", kwargs={"pk": threads[0].pk})
+        c.get(url + "?status=1")
+        with self.assertNumQueries(4):
+            response = c.get("/")
+        self.assertContains(response, "checked", 3)
+        for thread in threads:
+            self.assertContains(response, 'id="forum-thread-star-%s"' % thread.pk)
+
+        # Overridden templates may use any attribute of the thread
+        template = settings.TEMPLATES[0]
+        with self.settings(
+            TEMPLATES=[
+                {
+                    **template,
+                    "APP_DIRS": False,
+                    "OPTIONS": {
+                        **template["OPTIONS"],
+                        "loaders": [
+                            (
+                                "django.template.loaders.locmem.Loader",
+                                {
+                                    "tinyforum/thread_star.html": (
+                                        "<i>{{ thread.title }} {{ status|yesno }}</i>"
+                                    )
+                                },
+                            ),
+                            "django.template.loaders.app_directories.Loader",
+                        ],
+                    },
+                }
+            ]
+        ):
+            response = c.get("/")
+        for i, status in enumerate(["yes", "yes", "no", "yes", "no"]):
+            self.assertContains(response, "<i>Thread %s %s</i>" % (i, status))
+
     def test_post_str(self):
         t = Thread.objects.create(title="One", authored_by=self.user1)
         p = Post.objects.create(
@@ -299,3 +411,1429 @@ class ForumTests(TestCase):
 
         t.moderation_status = t.HIDDEN
         self.assertEqual(t.get_absolute_url(), "/")
+
+    def test_keyset_pagination(self):
+        t = Thread.objects.create(title="One", authored_by=self.user1)
+        start = timezone.now() - timedelta(days=1)
+        for i in range(44):
+            Post.objects.create(
+                thread=t,
+                authored_by=self.user1,
+                text="<p>Post %s</p>" % i,
+                created_at=start + timedelta(minutes=i),
+            )
+        t.refresh_from_db()
+        self.assertEqual(t.post_count, 44)
+
+        c = Client()
+        with self.assertNumQueries(3):
+            # Last modification, thread and posts of the last page, no
+            # COUNT(*)
+            response = c.get(t.get_absolute_url() + "?page=last")
+        self.assertEqual(response.context["object_list"].number, 2)
+        self.assertEqual(
+            [p.text for p in response.context["object_list"]],
+            ["<p>Post %s</p>" % i for i in range(20, 44)],
+        )
+
+        previous = response.context["object_list"].previous_cursor
+        query = urlencode({"before": previous, "page": 1})
+        self.assertContains(response, 'href="?%s"' % escape(query))
+
+        response = c.get(t.get_absolute_url(), {"page": 1, "before": previous})
+        self.assertEqual(
+            [p.text for p in response.context["object_list"]],
+            ["<p>Post %s</p>" % i for i in range(20)],
+        )
+
+        for i in range(20):
+            Post.objects.create(
+                thread=t,
+                authored_by=self.user1,
+                text="<p>Post %s</p>" % (44 + i),
+                created_at=start + timedelta(minutes=44 + i),
+            )
+
+        response = c.get(t.get_absolute_url() + "?page=2")
+        page = response.context["object_list"]
+        self.assertEqual(
+            [p.text for p in page], ["<p>Post %s</p>" % i for i in range(20, 40)]
+        )
+        query = urlencode({"after": page.next_cursor, "page": 3})
+        self.assertContains(response, 'href="?%s"' % escape(query))
+
+        response = c.get(t.get_absolute_url(), {"page": 3, "after": page.next_cursor})
+        self.assertEqual(
+            [p.text for p in response.context["object_list"]],
+            ["<p>Post %s</p>" % i for i in range(40, 64)],
+        )
+
+        # Invalid cursors fall back to OFFSET pagination
+        response = c.get(t.get_absolute_url() + "?page=3&after=invalid")
+        self.assertEqual(
+            [p.text for p in response.context["object_list"]],
+            ["<p>Post %s</p>" % i for i in range(40, 64)],
+        )
+
+    def test_keyset_seek(self):
+        t = Thread.objects.create(title="One", authored_by=self.user1)
+        start = timezone.now() - timedelta(days=1)
+        Post.objects.bulk_create(
+            [
+                Post(
+                    thread=t,
+                    authored_by=self.user1,
+                    text="%s" % i,
+                    created_at=start + timedelta(minutes=i // 2),
+                )
+                for i in range(80)
+            ]
+        )
+        Thread.objects.recount()
+
+        c = Client()
+
+        def texts(response):
+            return [int(p.text) for p in response.context["object_list"]]
+
+        # Page 2 is neither the first nor the last page
+        response = c.get(t.get_absolute_url(), {"page": 2})
+        self.assertEqual(texts(response), list(range(20, 40)))
+        page = response.context["object_list"]
+
+        # Seeking works with equal timestamps
+        with self.assertNumQueries(3):
+            # Last modification, thread and posts
+            response = c.get(
+                t.get_absolute_url(), {"page": 3, "after": page.next_cursor}
+            )
+        self.assertEqual(texts(response), list(range(40, 60)))
+        page = response.context["object_list"]
+        response = c.get(
+            t.get_absolute_url(), {"page": 2, "before": page.previous_cursor}
+        )
+        self.assertEqual(texts(response), list(range(20, 40)))
+
+        # Invalid numbers and cursors
+        for params, expected in [
+            ({"page": "abc"}, range(20)),
+            ({"page": 99}, range(60, 80)),
+            ({"page": 2, "after": "1~2~3"}, range(20, 40)),
+            ({"page": 2, "before": "invalid~1"}, range(20, 40)),
+        ]:
+            with self.subTest(params=params):
+                response = c.get(t.get_absolute_url(), params)
+                self.assertEqual(texts(response), list(expected))
+
+        # Related keys and missing values
+        paginator = KeysetPaginator(
+            Thread.objects.all(), 10, keys=("latest_post__created_at", "id")
+        )
+        t.refresh_from_db()
+        self.assertEqual(
+            paginator.cursor(t),
+            "%s~%s" % (t.latest_post.created_at.isoformat(), t.pk),
+        )
+        self.assertEqual(paginator.cursor(Thread()), "")
+
+        # OFFSET pagination without keys
+        request = SimpleNamespace(GET={"page": "last"})
+        page = paginate_list(request, t.posts.all(), paginate_by=30)
+        self.assertEqual((page.number, len(page)), (3, 20))
+
+    def test_thread_counters(self):
+        t = Thread.objects.create(title="One", authored_by=self.user1)
+        p1 = Post.objects.create(thread=t, text="One", authored_by=self.user1)
+        p2 = Post.objects.create(thread=t, text="Two", authored_by=self.user2)
+
+        t.refresh_from_db()
+        self.assertEqual((t.post_count, t.latest_post), (2, p2))
+
+        # Editing neither changes the count nor the latest post
+        p2 = Post.objects.get(pk=p2.pk)
+        with self.assertNumQueries(3):
+            # Updating the post, the search index and the thread's
+            # modification time
+            p2.text = "Two edited"
+            p2.save()
+
+        # Hiding the latest post
+        p2.moderation_status = p2.HIDDEN
+        p2.save()
+        t.refresh_from_db()
+        self.assertEqual((t.post_count, t.latest_post), (1, p1))
+        self.assertEqual(
+            (t.latest_post_at, t.latest_post_author), (p1.created_at, "user1")
+        )
+
+        # Unhiding it again
+        p2.moderation_status = p2.GOOD
+        p2.save()
+        t.refresh_from_db()
+        self.assertEqual((t.post_count, t.latest_post), (2, p2))
+        self.assertEqual(
+            (t.latest_post_at, t.latest_post_author), (p2.created_at, "user2")
+        )
+
+        # Hiding an older post does not touch the latest post
+        p1.moderation_status = p1.HIDDEN
+        p1.save()
+        t.refresh_from_db()
+        self.assertEqual((t.post_count, t.latest_post), (1, p2))
+
+        # Saving the thread does not overwrite the counters with stale values
+        stale = Thread.objects.get(pk=t.pk)
+        Post.objects.create(thread=t, text="Three", authored_by=self.user1)
+        stale.title = "Two"
+        stale.save()
+        t.refresh_from_db()
+        self.assertEqual((t.title, t.post_count), ("Two", 2))
+
+        # Inserts write all fields
+        copy = Thread.objects.get(pk=t.pk)
+        copy.pk = None
+        copy.latest_post = None
+        copy.save(force_insert=True)
+        copy.refresh_from_db()
+        self.assertEqual((copy.title, copy.post_count), ("Two", 2))
+        # Saving a thread which has been deleted concurrently
+        Thread.objects.filter(pk=copy.pk).delete()
+        copy.save()
+        self.assertEqual(Thread.objects.get(pk=copy.pk).post_count, 2)
+        copy.post_count = 0
+        copy.save(update_fields=["post_count"])
+        self.assertEqual(Thread.objects.get(pk=copy.pk).post_count, 0)
+
+        # Unknown previous state recounts the thread
+        Thread.objects.filter(pk=t.pk).update(post_count=42)
+        Post(pk=p1.pk, thread=t, text="One", authored_by=self.user1).save()
+        t.refresh_from_db()
+        self.assertEqual(t.post_count, 3)
+
+    def test_recount_command(self):
+        t = Thread.objects.create(title="One", authored_by=self.user1)
+        p = Post.objects.create(thread=t, text="One", authored_by=self.user1)
+        empty = Thread.objects.create(title="Two", authored_by=self.user1)
+        Thread.objects.update(post_count=7, latest_post=None)
+
+        stdout = io.StringIO()
+        command = "tinyforum.management.commands.tinyforum_recount"
+        with mock.patch("tinyforum.models.bump_versions") as recount_bump:
+            with mock.patch("%s.bump_versions" % command) as command_bump:
+                call_command("tinyforum_recount", chunk_size=1, stdout=stdout)
+        self.assertEqual(stdout.getvalue(), "Recounted 2 threads.\n")
+        # Cached pages are invalidated once, not once per chunk
+        self.assertEqual(recount_bump.call_count, 0)
+        command_bump.assert_called_once_with([GENERATION_VERSION_KEY])
+
+        t.refresh_from_db()
+        self.assertEqual((t.post_count, t.latest_post), (1, p))
+        empty.refresh_from_db()
+        self.assertEqual((empty.post_count, empty.latest_post), (0, None))
+        self.assertEqual(
+            (empty.latest_post_at, empty.latest_post_author), (empty.created_at, "")
+        )
+
+        # Only drifted threads are recounted
+        Thread.objects.filter(pk=t.pk).update(post_count=5, latest_post_author="x")
+        stdout = io.StringIO()
+        call_command("tinyforum_recount", dry_run=True, chunk_size=1, stdout=stdout)
+        self.assertEqual(
+            stdout.getvalue(),
+            "Thread %s: post_count 5 -> 1, latest_post_author x -> user1\n"
+            "1 of 2 threads have drifted.\n" % t.pk,
+        )
+        t.refresh_from_db()
+        self.assertEqual(t.post_count, 5)
+
+        stdout = io.StringIO()
+        call_command("tinyforum_recount", empty.pk, stdout=stdout)
+        self.assertEqual(stdout.getvalue(), "Recounted 0 threads.\n")
+
+        stdout = io.StringIO()
+        call_command(
+            "tinyforum_recount",
+            modified_since="2000-01-01T00:00:00",
+            verbosity=2,
+            stdout=stdout,
+        )
+        self.assertEqual(stdout.getvalue().splitlines()[-1], "Recounted 1 threads.")
+        t.refresh_from_db()
+        self.assertEqual((t.post_count, t.latest_post_author), (1, "user1"))
+
+        with self.assertRaisesRegex(CommandError, "Invalid date 'yesterday'"):
+            call_command("tinyforum_recount", modified_since="yesterday")
+
+    def test_import_command(self):
+        lines = [
+            {"type": "thread", "title": "Old", "author": "user1"},
+            {
+                "type": "post",
+                "text": "<p>First<script>alert(1)</script></p>",
+                "author": "user1",
+                "created_at": "2010-01-01T12:00:00",
+            },
+            {
+                "type": "post",
+                "text": "<p>Second</p>",
+                "author": "legacy",
+                "created_at": "2010-01-02T12:00:00",
+            },
+            {
+                "type": "post",
+                "text": "<p>Hidden</p>",
+                "author": "legacy",
+                "created_at": "2010-01-03T12:00:00",
+                "moderation_status": "hidden",
+            },
+            {
+                "type": "thread",
+                "title": "Closed",
+                "author": "legacy",
+                "created_at": "2010-02-01T12:00:00",
+                "closed_at": "2010-03-01T12:00:00",
+                "is_pinned": True,
+            },
+        ]
+        path = self.write_lines(lines)
+
+        with self.assertRaisesRegex(
+            CommandError, r"Line 3: Unknown users \['legacy'\]"
+        ):
+            call_command("tinyforum_import", path, workers=0, chunk_size=10)
+        self.assertFalse(Thread.objects.exists())
+
+        stdout = io.StringIO()
+        call_command(
+            "tinyforum_import",
+            path,
+            chunk_size=2,
+            workers=2,
+            create_users=True,
+            stdout=stdout,
+        )
+        self.assertEqual(stdout.getvalue(), "Imported 2 threads and 3 posts.\n")
+
+        old, closed = Thread.objects.order_by("pk")
+        self.assertEqual(old.authored_by, self.user1)
+        self.assertEqual(old.post_count, 2)
+        self.assertEqual(old.latest_post.text, "<p>Second</p>")
+        self.assertEqual(old.latest_post_author, "legacy")
+        self.assertEqual(
+            list(old.posts.values_list("text", flat=True)),
+            ["<p>First</p>", "<p>Second</p>", "<p>Hidden</p>"],
+        )
+        self.assertEqual((closed.post_count, closed.is_pinned), (0, True))
+        self.assertEqual(closed.closed_at.month, 3)
+        self.assertEqual(
+            list(
+                Post.objects.filter(post_matches("second")).values_list("pk", flat=True)
+            ),
+            [old.latest_post.pk],
+        )
+
+        for line, message in [
+            ({"type": "post", "text": "", "author": "user1"}, "Post without a thread"),
+            ({"type": "user"}, "Unknown type 'user'"),
+            ({"title": "No type"}, "KeyError"),
+            (
+                {"type": "thread", "title": "T", "author": "user1", "created_at": "x"},
+                "Invalid date 'x'",
+            ),
+            (
+                {
+                    "type": "thread",
+                    "title": "T",
+                    "author": "user1",
+                    "moderation_status": "bad",
+                },
+                "Invalid moderation status 'bad'",
+            ),
+        ]:
+            with self.subTest(message=message):
+                with self.assertRaisesRegex(CommandError, "Line 1: .*%s" % message):
+                    call_command(
+                        "tinyforum_import", self.write_lines([line]), workers=0
+                    )
+
+        # Posts of the last thread are recounted also after errors
+        path = self.write_lines(
+            [
+                {"type": "thread", "title": "Partial", "author": "user1"},
+                {"type": "post", "text": "<p>Imported</p>", "author": "user1"},
+                {"type": "post", "text": "<p>Not</p>", "author": "unknown"},
+            ]
+        )
+        with self.assertRaises(CommandError):
+            call_command("tinyforum_import", path, workers=0, chunk_size=2)
+        self.assertEqual(Thread.objects.get(title="Partial").post_count, 1)
+
+        stdin = io.StringIO(
+            '\n{"type": "thread", "title": "Stdin", "author": "user1"}\n'
+        )
+        with mock.patch("sys.stdin", stdin):
+            call_command("tinyforum_import", "-", workers=0, stdout=stdout)
+        self.assertTrue(Thread.objects.filter(title="Stdin").exists())
+
+        call_command("tinyforum_import", self.write_lines([]), stdout=stdout)
+        with override_settings(USE_TZ=True):
+            self.assertTrue(
+                timezone.is_aware(ImportCommand().datetime("2010-01-01T12:00:00"))
+            )
+
+    @skipUnless(sys.version_info >= (3, 7), "Workers are forked")
+    def test_import_command_spawn(self):
+        # Spawned workers set up Django using the settings module of tests/manage.py
+        lines = [{"type": "thread", "title": "Spawn", "author": "user1"}] + [
+            {
+                "type": "post",
+                "text": "<p>%s<script></script></p>" % i,
+                "author": "user1",
+            }
+            for i in range(12)
+        ]
+        with mock.patch.dict(
+            os.environ, {"DJANGO_SETTINGS_MODULE": "testapp.settings"}
+        ), mock.patch(
+            "multiprocessing.get_context", wraps=multiprocessing.get_context
+        ) as get_context:
+            call_command(
+                "tinyforum_import",
+                self.write_lines(lines),
+                chunk_size=5,
+                workers=3,
+                stdout=io.StringIO(),
+            )
+        get_context.assert_called_once_with("spawn")
+        self.assertEqual(
+            list(Post.objects.order_by("pk").values_list("text", flat=True)),
+            ["<p>%s</p>" % i for i in range(12)],
+        )
+        self.assertEqual(Thread.objects.get().post_count, 12)
+
+    def test_export(self):
+        t1 = Thread.objects.create(title="One", authored_by=self.user1)
+        t2 = Thread.objects.create(title="Two", authored_by=self.user2)
+        empty = Thread.objects.create(title="Empty", authored_by=self.user1)
+        p1 = Post.objects.create(thread=t2, text="<p>A</p>", authored_by=self.user1)
+        p2 = Post.objects.create(thread=t1, text="<p>B</p>", authored_by=self.user2)
+        # The latest post orders t2 before t1 in Thread.Meta.ordering
+        p3 = Post.objects.create(thread=t2, text="<p>C</p>", authored_by=self.user1)
+        PostReport.objects.create(post=p2, authored_by=self.user1, reason="spam")
+        t2.starred_by.add(self.user1)
+
+        def records(data):
+            return [json.loads(line) for line in b"".join(data).splitlines()]
+
+        path = os.path.join(tempfile.mkdtemp(), "forum.jsonl")
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        call_command("tinyforum_export", path, chunk_size=1)
+        with open(path, "rb") as f:
+            forum = records(f)
+        self.assertEqual(
+            [(r["type"], r.get("id")) for r in forum],
+            [
+                ("thread", t1.pk),
+                ("post", p2.pk),
+                ("thread", t2.pk),
+                ("post", p1.pk),
+                ("post", p3.pk),
+                ("thread", empty.pk),
+                ("report", p2.reports.get().pk),
+                ("star", None),
+            ],
+        )
+        self.assertEqual(forum[1]["author"], "user2")
+        self.assertEqual(forum[1]["thread"], t1.pk)
+        self.assertEqual(forum[-1], {"type": "star", "thread": t2.pk, "user": "user1"})
+
+        call_command("tinyforum_export", path, user="admin")
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), b"")
+
+        with self.assertRaisesRegex(CommandError, "Unknown user 'nobody'"):
+            call_command("tinyforum_export", user="nobody")
+
+        stdout = SimpleNamespace(buffer=io.BytesIO())
+        with mock.patch("sys.stdout", stdout):
+            call_command("tinyforum_export", user="user2", format="zip")
+        with zipfile.ZipFile(stdout.buffer) as archive:
+            user2 = records([archive.read("forum.jsonl")])
+        self.assertEqual(
+            [(r["type"], r["id"]) for r in user2],
+            [("post", p2.pk), ("thread", t2.pk)],
+        )
+
+        c = Client()
+        c.force_login(self.user2)
+        response = c.get("/export/", {"format": "jsonl"})
+        self.assertEqual(response["content-type"], "application/x-ndjson")
+        self.assertEqual(
+            response["content-disposition"],
+            'attachment; filename="forum-%s.jsonl"' % self.user2.pk,
+        )
+        self.assertEqual(records(response.streaming_content), user2)
+
+        response = c.get("/export/")
+        self.assertEqual(response["content-type"], "application/zip")
+        archive = zipfile.ZipFile(io.BytesIO(b"".join(response.streaming_content)))
+        self.assertEqual(records([archive.read("forum.jsonl")]), user2)
+
+        response = c.get("/moderation/export/")
+        self.assertEqual(response.status_code, 302)
+        c.force_login(self.admin)
+        response = c.get("/moderation/export/", {"format": "jsonl"})
+        self.assertEqual(
+            response["content-disposition"], 'attachment; filename="forum.jsonl"'
+        )
+        self.assertEqual(records(response.streaming_content), forum)
+
+        # The export of the forum can be imported again
+        call_command("tinyforum_export", path)
+        call_command("tinyforum_import", path, workers=0, stdout=io.StringIO())
+        self.assertEqual(Thread.objects.filter(title="Two").count(), 2)
+        self.assertEqual(Post.objects.count(), 6)
+        self.assertEqual(Thread.objects.filter(title="Two").latest("pk").post_count, 2)
+
+    def write_lines(self, lines):
+        with tempfile.NamedTemporaryFile("w", suffix=".jsonl", delete=False) as f:
+            f.write("\n".join(json.dumps(line) for line in lines))
+        self.addCleanup(os.remove, f.name)
+        return f.name
+
+    def test_generate_command(self):
+        users = User.objects.count()
+        stdout = io.StringIO()
+        call_command(
+            "tinyforum_generate",
+            users=5,
+            threads=10,
+            posts=4,
+            reports=0.5,
+            hidden=0.2,
+            batch_size=7,
+            stdout=stdout,
+        )
+        self.assertEqual(User.objects.count(), users + 5)
+        self.assertEqual(Thread.objects.count(), 10)
+        posts = Post.objects.count()
+        self.assertIn(
+            "Generated 5 users, 10 threads, %s posts" % posts, stdout.getvalue()
+        )
+        self.assertTrue(PostReport.objects.exists())
+        self.assertTrue(Thread.starred_by.through.objects.exists())
+
+        # Counters are consistent and posts are searchable
+        self.assertEqual(
+            sum(Thread.objects.values_list("post_count", flat=True)),
+            Post.objects.visible().count(),
+        )
+        self.assertEqual(
+            Post.objects.filter(post_matches("lorem")).count(),
+            Post.objects.filter(text__contains="lorem").count(),
+        )
+
+        with self.assertRaises(CommandError):
+            call_command("tinyforum_generate", alpha=1)
+        with self.assertRaises(CommandError):
+            call_command("tinyforum_generate", users=0)
+
+        # The benchmark suite runs against the generated data
+        stdout = io.StringIO()
+        call_command("benchmark_forum", repeat=1, stdout=stdout)
+        data = json.loads(stdout.getvalue())
+        self.assertEqual(data["dataset"]["threads"], 10)
+        self.assertEqual(data["results"]["thread_list"]["runs"], 1)
+        self.assertEqual(Post.objects.count(), posts)
+
+    @skipUnless(connection.features.supports_partial_indexes, "Partial indexes")
+    def test_query_plans(self):
+        t = Thread.objects.create(title="One", authored_by=self.user1)
+        Post.objects.create(thread=t, text="One", authored_by=self.user1)
+
+        self.assertIn("tinyforum_post_visible", t.posts.visible().explain())
+        self.assertIn(
+            "tinyforum_post_visible",
+            t.posts.visible().order_by("-created_at", "-id")[:1].explain(),
+        )
+        self.assertIn("tinyforum_thread_active", Thread.objects.active().explain())
+
+    @override_settings(TINYFORUM_CACHE_PAGES=True)
+    def test_page_cache(self):
+        t = Thread.objects.create(title="One", authored_by=self.user1)
+        p = Post.objects.create(thread=t, text="First", authored_by=self.user1)
+
+        c = Client()
+        self.assertContains(c.get("/"), "One")
+        self.assertContains(c.get(t.get_absolute_url()), "First")
+        with self.assertNumQueries(2):
+            # Only the last modification of the page
+            self.assertContains(c.get("/"), "One")
+            self.assertContains(c.get(t.get_absolute_url()), "First")
+
+        # Pages of other threads stay cached when a post is added
+        other = Thread.objects.create(title="Two", authored_by=self.user1)
+        Post.objects.create(thread=other, text="Second", authored_by=self.user1)
+        self.assertContains(c.get("/"), "Two")
+        with self.assertNumQueries(1):
+            self.assertContains(c.get(t.get_absolute_url()), "First")
+
+        # Moderation invalidates the thread's pages
+        p.moderation_status = p.HIDDEN
+        p.save()
+        self.assertNotContains(c.get(t.get_absolute_url()), "First")
+
+        # Deletions invalidate the thread's pages and the thread list
+        deleted = Post.objects.create(thread=t, text="Deleted", authored_by=self.user1)
+        self.assertContains(c.get(t.get_absolute_url()), "Deleted")
+        deleted.delete()
+        self.assertNotContains(c.get(t.get_absolute_url()), "Deleted")
+        three = Thread.objects.create(title="Three", authored_by=self.user1)
+        self.assertContains(c.get("/"), "Three")
+        three.delete()
+        self.assertNotContains(c.get("/"), "Three")
+
+        # Recounting invalidates everything
+        Thread.objects.recount()
+        with self.assertNumQueries(3):
+            # Last modification, thread and posts
+            c.get(other.get_absolute_url())
+
+        # Pages are cached per language and host
+        with override_settings(LANGUAGES=[("en", "English"), ("de", "German")]):
+            german = "Anmelden"
+            self.assertContains(c.get("/", HTTP_ACCEPT_LANGUAGE="de"), german)
+            self.assertNotContains(c.get("/", HTTP_ACCEPT_LANGUAGE="en"), german)
+            self.assertContains(c.get("/", HTTP_ACCEPT_LANGUAGE="de"), german)
+        with override_settings(ALLOWED_HOSTS=["testserver", "example.com"]):
+            with self.assertNumQueries(3):
+                c.get("/", HTTP_HOST="example.com")
+            with self.assertNumQueries(1):
+                c.get("/", HTTP_HOST="example.com")
+
+        # Errors are not cached
+        hidden = Thread.objects.create(
+            title="Hidden", authored_by=self.user1, moderation_status="hidden"
+        )
+        url = reverse("tinyforum:thread-detail", kwargs={"pk": hidden.pk})
+        self.assertEqual(c.get(url).status_code, 404)
+        Thread.objects.filter(pk=hidden.pk).update(moderation_status="good")
+        self.assertEqual(c.get(url).status_code, 200)
+
+        responses = iter([HttpResponseRedirect("/"), HttpResponse("Hello")])
+        view = cache_anonymous_page(lambda request: [])(lambda request: next(responses))
+        request = SimpleNamespace(
+            method="GET",
+            user=AnonymousUser(),
+            build_absolute_uri=lambda: "http://testserver/redirect/",
+            _messages=[],
+        )
+        self.assertEqual(view(request).status_code, 302)
+        self.assertEqual(view(request).content, b"Hello")
+        self.assertEqual(view(request).content, b"Hello")
+
+        # Logged-in users are never served cached pages
+        c.force_login(self.user2)
+        self.assertContains(c.get("/"), "data-set-status", 3)
+        self.assertContains(c.get("/"), "data-set-status", 3)
+
+    def test_conditional_get(self):
+        t = Thread.objects.create(title="One", authored_by=self.user1)
+        p = Post.objects.create(thread=t, text="First", authored_by=self.user1)
+
+        c = Client()
+        response = c.get(t.get_absolute_url())
+        self.assertTrue(response.has_header("Last-Modified"))
+        etag = response["ETag"]
+
+        with self.assertNumQueries(1):
+            response = c.get(t.get_absolute_url(), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        response = c.get("/")
+        list_etag = response["ETag"]
+        self.assertEqual(c.get("/", HTTP_IF_NONE_MATCH=list_etag).status_code, 304)
+
+        # Moderation changes the validators of the thread and the thread list
+        p.moderation_status = p.HIDDEN
+        p.save()
+        response = c.get(t.get_absolute_url(), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(c.get("/", HTTP_IF_NONE_MATCH=list_etag).status_code, 200)
+
+        # Deletions, e.g. in the admin or through a CASCADE, change them too
+        second = Post.objects.create(thread=t, text="Second", authored_by=self.user1)
+        etag = c.get(t.get_absolute_url())["ETag"]
+        second.delete()
+        response = c.get(t.get_absolute_url(), HTTP_IF_NONE_MATCH=etag)
+        self.assertNotContains(response, "Second")
+        t.refresh_from_db()
+        self.assertEqual((t.post_count, t.latest_post), (0, None))
+
+        etag = c.get(t.get_absolute_url())["ETag"]
+        p.delete()
+        response = c.get(t.get_absolute_url(), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        t.refresh_from_db()
+        self.assertEqual(t.post_count, 0)
+
+        user = User.objects.create_user("user3", "user3@example.com", "password")
+        other = Thread.objects.create(title="Other", authored_by=user)
+        list_etag = c.get("/")["ETag"]
+        user.delete()
+        response = c.get("/", HTTP_IF_NONE_MATCH=list_etag)
+        self.assertNotContains(response, "Other")
+        self.assertFalse(Thread.objects.filter(pk=other.pk).exists())
+
+        # Pages of logged-in users contain personal data
+        c.force_login(self.user1)
+        response = c.get(t.get_absolute_url())
+        self.assertFalse(response.has_header("ETag"))
+
+    def test_read_markers(self):
+        t = Thread.objects.create(title="One", authored_by=self.user1)
+        for i in range(30):
+            Post.objects.create(thread=t, text="Post %s" % i, authored_by=self.user1)
+        other = Thread.objects.create(title="Two", authored_by=self.user1)
+        Post.objects.create(thread=other, text="Post", authored_by=self.user1)
+
+        c = Client()
+        c.force_login(self.user2)
+        response = c.get("/")
+        self.assertEqual(
+            [thread.unread_count for thread in response.context["object_list"]],
+            [1, 30],
+        )
+
+        c.get(t.get_absolute_url())
+        self.assertEqual(ReadMarker.objects.get(user=self.user2).post_count, 20)
+        c.get(t.get_absolute_url() + "?page=last")
+        self.assertEqual(ReadMarker.objects.get(user=self.user2).post_count, 30)
+
+        with self.assertNumQueries(4):
+            # Session, user, thread, posts; no writes
+            c.get(t.get_absolute_url() + "?page=last")
+        with self.assertNumQueries(4):
+            # Going back does not move the marker backwards
+            c.get(t.get_absolute_url())
+
+        Post.objects.create(thread=t, text="New", authored_by=self.user1)
+        with self.assertNumQueries(4):
+            # Session, user, count and threads; unread counts are part of the
+            # thread list query and stars are cached
+            response = c.get("/")
+        self.assertEqual(
+            [thread.unread_count for thread in response.context["object_list"]],
+            [1, 1],
+        )
+        self.assertContains(response, '<span class="forum__unread">1 new</span>', 2)
+
+        # The marker is updated even if the cache does not know about it
+        get_cache().clear()
+        c.get(t.get_absolute_url() + "?page=last")
+        self.assertEqual(ReadMarker.objects.get(user=self.user2).post_count, 31)
+        get_cache().clear()
+        c.get(t.get_absolute_url())
+        marker = ReadMarker.objects.get(user=self.user2)
+        self.assertEqual(marker.post_count, 31)
+        self.assertEqual(str(marker), "%s: 31" % t.pk)
+
+        self.assertIsNone(Thread.objects.get(pk=t.pk).unread_count)
+
+    def test_search(self):
+        t = Thread.objects.create(title="Cooking with Django", authored_by=self.user1)
+        hidden = Thread.objects.create(
+            title="Hidden cooking", authored_by=self.user1, moderation_status="hidden"
+        )
+        p1 = Post.objects.create(
+            thread=t, text="<p>Pasta <b>recipes</b></p>", authored_by=self.user1
+        )
+        p2 = Post.objects.create(thread=t, text="Pizza recipes", authored_by=self.user2)
+        Post.objects.create(
+            thread=hidden, text="Secret recipes", authored_by=self.user1
+        )
+
+        client = Client()
+        response = client.get("/search/?q=recipes")
+        self.assertEqual(list(response.context["object_list"]), [p2, p1])
+        self.assertEqual(list(response.context["thread_list"]), [])
+        self.assertContains(response, "Pizza recipes")
+
+        response = client.get("/search/?q=cooking")
+        self.assertEqual(list(response.context["thread_list"]), [t])
+        self.assertEqual(list(response.context["object_list"]), [])
+        self.assertContains(response, "No posts found.")
+
+        response = client.get("/search/")
+        self.assertNotContains(response, "No posts found.")
+
+        # Terms are matched as words, not as query syntax
+        response = client.get("/search/?" + urlencode({"q": 'pasta "OR pizza'}))
+        self.assertEqual(list(response.context["object_list"]), [])
+
+        # Edits and moderation are picked up immediately
+        p1.text = "Pasta al pomodoro"
+        p1.save()
+        p2.moderation_status = "hidden"
+        p2.save()
+        response = client.get("/search/?q=recipes")
+        self.assertEqual(list(response.context["object_list"]), [])
+        response = client.get("/search/?q=pomodoro")
+        self.assertEqual(list(response.context["object_list"]), [p1])
+
+        # The admin finds hidden content too
+        client.force_login(self.admin)
+        response = client.get("/admin/tinyforum/post/?q=recipes")
+        self.assertEqual(
+            set(response.context["cl"].result_list), {p2, hidden.posts.get()}
+        )
+        response = client.get("/admin/tinyforum/post/?q=django")
+        self.assertEqual(set(response.context["cl"].result_list), {p1, p2})
+        response = client.get("/admin/tinyforum/post/")
+        self.assertEqual(len(response.context["cl"].result_list), 3)
+        response = client.get("/admin/tinyforum/thread/?q=cooking")
+        self.assertEqual(set(response.context["cl"].result_list), {t, hidden})
+        response = client.get("/admin/tinyforum/thread/")
+        self.assertEqual(len(response.context["cl"].result_list), 2)
+
+        Post.objects.update(text="Nothing")
+        stdout = io.StringIO()
+        call_command("tinyforum_search_index", chunk_size=2, stdout=stdout)
+        self.assertEqual(stdout.getvalue(), "Indexed 2 threads and 3 posts.\n")
+        response = client.get("/search/?q=pomodoro")
+        self.assertEqual(list(response.context["object_list"]), [])
+
+        # Index rows of deleted posts and threads are removed
+        def indexed(table):
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT rowid FROM %s ORDER BY rowid" % table)
+                return [row[0] for row in cursor.fetchall()]
+
+        hidden_post = hidden.posts.get()
+        hidden.delete()
+        self.assertEqual(indexed("tinyforum_thread_search"), [t.pk])
+        self.assertEqual(indexed("tinyforum_post_search"), [p1.pk, p2.pk])
+        self.assertNotIn(hidden_post.pk, indexed("tinyforum_post_search"))
+
+    def test_search_backends(self):
+        class Cursor:
+            def __init__(self):
+                self.statements = []
+
+            def executemany(self, sql, rows):
+                self.statements.append((sql, rows))
+
+        cursor = Cursor()
+        backend = PostgreSQLBackend()
+        with self.settings(TINYFORUM_SEARCH_CONFIG="german"):
+            backend.index(cursor, "tinyforum_post_search", [(1, "Hallo Welt")])
+            self.assertEqual(
+                backend.match("tinyforum_post_search", "welt"),
+                (
+                    "SELECT id FROM tinyforum_post_search"
+                    " WHERE document @@ plainto_tsquery(%s::regconfig, %s)",
+                    ["german", "welt"],
+                ),
+            )
+        self.assertEqual(
+            cursor.statements,
+            [
+                (
+                    "INSERT INTO tinyforum_post_search (id, document)"
+                    " VALUES (%s, to_tsvector(%s::regconfig, %s))"
+                    " ON CONFLICT (id) DO UPDATE SET document = EXCLUDED.document",
+                    [(1, "german", "Hallo Welt")],
+                )
+            ],
+        )
+
+        with mock.patch.object(connection, "vendor", "postgresql"):
+            self.assertIsInstance(get_backend(), PostgreSQLBackend)
+
+        # Other databases do not have an index and search using icontains
+        t = Thread.objects.create(title="Cooking", authored_by=self.user1)
+        with mock.patch.object(connection, "vendor", "mysql"):
+            self.assertIsNone(get_backend())
+            index_threads([t])
+            self.assertEqual(post_matches("pasta"), Q(text__icontains="pasta"))
+        index_threads([])
+        self.assertEqual(list(Thread.objects.filter(thread_matches("cooking"))), [t])
+
+    def test_bulk_moderation(self):
+        threads = [
+            Thread.objects.create(title=title, authored_by=self.user1)
+            for title in ["One", "Two"]
+        ]
+        posts = [
+            Post.objects.create(thread=t, text=text, authored_by=self.user1)
+            for t in threads
+            for text in ["Hello", "Spam"]
+        ]
+        reports = [
+            PostReport.objects.create(post=p, authored_by=user, reason="spam")
+            for p in posts[1::2]
+            for user in [self.user2, self.admin]
+        ]
+
+        handled = []
+        handled_each = []
+
+        def receiver(instances, request, **kwargs):
+            handled.append(sorted(report.pk for report in instances))
+
+        def receiver_each(instance, form, request, **kwargs):
+            handled_each.append(instance.pk)
+
+        post_reports_handled.connect(receiver)
+        self.addCleanup(post_reports_handled.disconnect, receiver)
+        # Existing receivers get every report handled in bulk too
+        post_report_handled.connect(receiver_each)
+        self.addCleanup(post_report_handled.disconnect, receiver_each)
+
+        c = Client()
+        c.force_login(self.admin)
+
+        response = c.get("/moderation/")
+        self.assertContains(response, 'name="reports"', 2)
+
+        response = c.post("/moderation/bulk/", {"moderation_status": "hidden"})
+        self.assertRedirects(response, "/moderation/")
+        self.assertEqual(messages(response), ["Please select reports and an action."])
+
+        with self.assertNumQueries(8):
+            # Session, user, validation, reports, update reports, threads,
+            # update posts and one recount for all threads
+            response = c.post(
+                "/moderation/bulk/",
+                {
+                    "moderation_status": "hidden",
+                    "reports": [r.pk for r in reports if r.authored_by == self.user2],
+                },
+            )
+        self.assertRedirects(response, "/moderation/")
+        self.assertEqual(messages(response), ["2 reports have been handled."])
+        self.assertEqual(handled, [[reports[0].pk, reports[2].pk]])
+        self.assertEqual(sorted(handled_each), [reports[0].pk, reports[2].pk])
+
+        for t in threads:
+            t.refresh_from_db()
+            self.assertEqual((t.post_count, t.latest_post.text), (1, "Hello"))
+        self.assertEqual(PostReport.objects.filter(handled_at__isnull=True).count(), 2)
+
+        # Nothing left to change
+        self.assertEqual(Post.objects.filter(pk=posts[0].pk).moderate("good"), 0)
+        # Nothing left to handle
+        self.assertEqual(
+            PostReport.objects.filter(pk=reports[0].pk).handle(
+                "good", handled_by=self.admin
+            ),
+            [],
+        )
+
+        # Admin actions
+        response = c.post(
+            "/admin/tinyforum/post/",
+            {
+                "action": "moderate_posts_good",
+                "_selected_action": [p.pk for p in posts],
+            },
+        )
+        self.assertRedirects(response, "/admin/tinyforum/post/")
+        self.assertEqual(messages(response), ["Updated 2 posts."])
+        threads[0].refresh_from_db()
+        self.assertEqual(threads[0].post_count, 2)
+
+        response = c.post(
+            "/admin/tinyforum/postreport/",
+            {
+                "action": "handle_reports_hidden",
+                "_selected_action": [r.pk for r in reports],
+            },
+        )
+        self.assertRedirects(response, "/admin/tinyforum/postreport/")
+        self.assertEqual(messages(response), ["Handled 2 reports."])
+        self.assertEqual(handled[-1], [reports[1].pk, reports[3].pk])
+        self.assertEqual(
+            list(Post.objects.values_list("moderation_status", flat=True)),
+            ["good", "hidden", "good", "hidden"],
+        )
+
+    def test_purge(self):
+        spammer = User.objects.create_user("spammer")
+        own = Thread.objects.create(title="Spam", authored_by=spammer)
+        Post.objects.create(thread=own, text="Spam", authored_by=spammer)
+        Post.objects.create(thread=own, text="Reply", authored_by=self.user1)
+        threads = [
+            Thread.objects.create(title=title, authored_by=self.user1)
+            for title in ["One", "Two"]
+        ]
+        for t in threads:
+            Post.objects.create(thread=t, text="Hello", authored_by=self.user1)
+            spam = Post.objects.create(thread=t, text="Spam", authored_by=spammer)
+        report = PostReport.objects.create(
+            post=spam, authored_by=self.user2, reason="spam"
+        )
+        own_report = PostReport.objects.create(
+            post=threads[0].posts.first(), authored_by=spammer, reason="spam"
+        )
+        for t in threads:
+            t.refresh_from_db()
+            self.assertEqual((t.post_count, t.latest_post_author), (2, "spammer"))
+
+        with self.assertRaisesRegex(CommandError, r"Unknown users \['nobody'\]"):
+            call_command("tinyforum_purge", "spammer", "nobody")
+
+        stdout = io.StringIO()
+        with mock.patch("tinyforum.models.RECOUNT_CHUNK_SIZE", 2), mock.patch(
+            "tinyforum.models.bump_versions"
+        ) as models_bump, self.assertNumQueries(11):
+            # Threads are recounted in chunks, the generation is bumped once
+            call_command("tinyforum_purge", "spammer", stdout=stdout)
+        models_bump.assert_not_called()
+        self.assertEqual(
+            stdout.getvalue(),
+            "Hid 1 threads, 3 posts and 2 reports, recounted 3 threads.\n",
+        )
+        for t in threads:
+            t.refresh_from_db()
+            self.assertEqual((t.post_count, t.latest_post_author), (1, "user1"))
+        own.refresh_from_db()
+        self.assertEqual((own.moderation_status, own.post_count), ("hidden", 1))
+        report.refresh_from_db()
+        self.assertEqual(report.moderation_status, "hidden")
+        own_report.refresh_from_db()
+        self.assertEqual(own_report.moderation_status, "flagged")
+        self.assertIsNotNone(own_report.handled_at)
+        self.assertEqual(Post.objects.filter(moderation_status="hidden").count(), 3)
+
+        # Nothing left to hide
+        stdout = io.StringIO()
+        call_command("tinyforum_purge", "spammer", stdout=stdout)
+        self.assertEqual(
+            stdout.getvalue(),
+            "Hid 0 threads, 0 posts and 0 reports, recounted 0 threads.\n",
+        )
+
+        stdout = io.StringIO()
+        call_command("tinyforum_purge", "spammer", delete=True, stdout=stdout)
+        self.assertEqual(
+            stdout.getvalue(),
+            "Deleted 1 threads, 4 posts and 2 reports, recounted 2 threads.\n",
+        )
+        self.assertEqual(list(Thread.objects.order_by("pk")), threads)
+        self.assertEqual(Post.objects.count(), 2)
+        self.assertEqual(PostReport.objects.count(), 0)
+        for t in threads:
+            t.refresh_from_db()
+            self.assertEqual((t.post_count, t.latest_post_author), (1, "user1"))
+
+        # Admin actions only hide content
+        t = threads[1]
+        spam = Post.objects.create(thread=t, text="Spam", authored_by=spammer)
+        c = Client()
+        c.force_login(self.admin)
+        response = c.post(
+            "/admin/tinyforum/post/",
+            {"action": "purge_authors", "_selected_action": [spam.pk]},
+        )
+        self.assertRedirects(response, "/admin/tinyforum/post/")
+        self.assertEqual(messages(response), ["Hid 0 threads, 1 posts and 0 reports."])
+        t.refresh_from_db()
+        self.assertEqual((t.post_count, t.latest_post_author), (1, "user1"))
+
+        response = c.post(
+            "/admin/tinyforum/thread/",
+            {"action": "purge_authors", "_selected_action": [t.pk]},
+        )
+        # Purges all content of user1
+        self.assertEqual(messages(response), ["Hid 2 threads, 2 posts and 0 reports."])
+        self.assertEqual(Thread.objects.visible().count(), 0)
+        self.assertEqual(Post.objects.visible().count(), 0)
+
+    def test_report_queue(self):
+        t = Thread.objects.create(title="One", authored_by=self.user1)
+        spam = Post.objects.create(thread=t, text="Buy stuff", authored_by=self.user1)
+        other = Post.objects.create(thread=t, text="Meh", authored_by=self.user1)
+        PostReport.objects.create(post=spam, authored_by=self.user1, reason="spam")
+        PostReport.objects.create(post=spam, authored_by=self.user2, reason="spam")
+        PostReport.objects.create(post=spam, authored_by=self.admin, reason="misplaced")
+        PostReport.objects.create(
+            post=other,
+            authored_by=self.user2,
+            reason="annoying",
+            handled_at=timezone.now(),
+        )
+
+        c = Client()
+        c.force_login(self.admin)
+
+        with self.assertNumQueries(4):
+            # Session, user, count and aggregated page
+            response = c.get("/moderation/queue/")
+        self.assertEqual(list(response.context["object_list"]), [spam])
+        post = response.context["object_list"][0]
+        # The moderator's own report is not counted
+        self.assertEqual(post.report_count, 2)
+        self.assertEqual(post.report_reasons, [("It's spam", 2)])
+        self.assertContains(response, "2 reports")
+
+        response = c.post("/moderation/post/%s/" % spam.pk, {})
+        self.assertRedirects(response, "/moderation/queue/")
+        self.assertEqual(messages(response), ["Please select an action."])
+
+        response = c.post(
+            "/moderation/post/%s/" % spam.pk, {"moderation_status": "hidden"}
+        )
+        self.assertRedirects(response, "/moderation/queue/")
+        self.assertEqual(messages(response), ["2 reports have been handled."])
+
+        spam.refresh_from_db()
+        self.assertEqual(spam.moderation_status, "hidden")
+        t.refresh_from_db()
+        self.assertEqual(t.post_count, 1)
+
+        response = c.get("/moderation/queue/")
+        self.assertContains(response, "Yay, all reports have been handled!")
+
+        # The moderator's own report is still open for others
+        self.assertEqual(
+            [(post, post.report_count_misplaced) for post in Post.objects.reported()],
+            [(spam, 1)],
+        )
+
+    def test_report_queue_claims(self):
+        t = Thread.objects.create(title="One", authored_by=self.user1)
+        spam = Post.objects.create(thread=t, text="Buy stuff", authored_by=self.user1)
+        reports = [
+            PostReport.objects.create(
+                post=spam,
+                authored_by=User.objects.create_user("reporter%s" % i),
+                reason="spam",
+            )
+            for i in range(5)
+        ]
+        m1 = User.objects.create_user("m1", is_staff=True)
+        m2 = User.objects.create_user("m2", is_staff=True)
+        self.assertEqual(PostReport.objects.claim(m1, count=3), reports[:3])
+
+        # Reports claimed by m1 are neither listed nor handled for m2
+        c = Client()
+        c.force_login(m2)
+        response = c.get("/moderation/queue/")
+        self.assertEqual(response.context["object_list"][0].report_count, 2)
+        self.assertContains(response, "2 reports")
+        response = c.post(
+            "/moderation/post/%s/" % spam.pk, {"moderation_status": "hidden"}
+        )
+        self.assertEqual(messages(response), ["2 reports have been handled."])
+        response = c.get("/moderation/queue/")
+        self.assertContains(response, "Yay, all reports have been handled!")
+
+        c.force_login(m1)
+        response = c.get("/moderation/queue/")
+        self.assertEqual(response.context["object_list"][0].report_count, 3)
+        response = c.post(
+            "/moderation/post/%s/" % spam.pk, {"moderation_status": "hidden"}
+        )
+        self.assertEqual(messages(response), ["3 reports have been handled."])
+        self.assertEqual(list(Post.objects.reported()), [])
+
+    def test_report_claims(self):
+        t = Thread.objects.create(title="One", authored_by=self.user1)
+        posts = [
+            Post.objects.create(thread=t, text=str(i), authored_by=self.user1)
+            for i in range(3)
+        ]
+        reports = [
+            PostReport.objects.create(post=p, authored_by=self.user1, reason="spam")
+            for p in posts
+        ]
+        moderator = User.objects.create_user("moderator", is_staff=True)
+
+        first = PostReport.objects.claim(self.admin, count=2)
+        self.assertEqual(first, reports[:2])
+        self.assertEqual(first[0].claimed_by, self.admin)
+        # Claiming again returns the same batch
+        self.assertEqual(PostReport.objects.claim(self.admin, count=2), first)
+
+        self.assertEqual(PostReport.objects.claim(moderator), reports[2:])
+        self.assertEqual(PostReport.objects.claim(self.user2), [])
+        self.assertEqual(list(PostReport.objects.available(moderator)), reports[2:])
+
+        # Expired claims return to the queue
+        PostReport.objects.filter(pk=reports[0].pk).update(
+            claimed_until=timezone.now() - timedelta(seconds=1)
+        )
+        self.assertEqual(PostReport.objects.claim(moderator), [reports[0], reports[2]])
+
+        c = Client()
+        c.force_login(self.admin)
+        response = c.get("/moderation/")
+        self.assertEqual(list(response.context["object_list"]), [reports[1]])
+        response = c.get(
+            reverse("tinyforum:report-handle", kwargs={"pk": reports[0].pk})
+        )
+        self.assertEqual(response.status_code, 404)
+
+        response = c.get("/moderation/")
+        self.assertContains(response, "Claim a batch of reports")
+        self.assertNotContains(response, "Release my reports")
+
+        # Showing the claimed reports does not claim anything
+        PostReport.objects.filter(pk=reports[1].pk).update(claimed_until=None)
+        response = c.get("/moderation/claim/")
+        self.assertEqual(list(response.context["object_list"]), [])
+        self.assertIsNone(PostReport.objects.get(pk=reports[1].pk).claimed_until)
+
+        response = c.post("/moderation/claim/")
+        self.assertRedirects(response, "/moderation/claim/")
+        response = c.get("/moderation/claim/")
+        self.assertEqual(list(response.context["object_list"]), [reports[1]])
+        self.assertContains(response, "Release my reports")
+
+        response = c.post("/moderation/claim/", {"release": "1"})
+        self.assertRedirects(response, "/moderation/")
+        self.assertEqual(PostReport.objects.available(self.user2).count(), 1)
+
+    def test_outbox(self):
+        t = Thread.objects.create(title="One", authored_by=self.user1)
+        p = Post.objects.create(thread=t, text="Spam", authored_by=self.user1)
+        report = PostReport.objects.create(
+            post=p, authored_by=self.user2, reason="spam"
+        )
+
+        sent = []
+        savepoints = []
+
+        def receiver(signal, sender, **kwargs):
+            savepoints.append(len(connection.savepoint_ids))
+            if kwargs.get("instance") == report:
+                raise Exception("Boom")
+            sent.append((signal, kwargs))
+
+        for signal in [post_created, post_report_handled, post_reports_handled]:
+            signal.connect(receiver)
+            self.addCleanup(signal.disconnect, receiver)
+
+        # Synchronous receivers do not run in a transaction of their own
+        c = Client()
+        c.force_login(self.user1)
+        c.post(t.get_absolute_url(), {"text": "Sync"})
+        self.assertEqual(savepoints, [len(connection.savepoint_ids)])
+        sent.clear()
+
+        with override_settings(TINYFORUM_OUTBOX=True):
+            c.post(t.get_absolute_url(), {"text": "Hello"})
+            PostReport.objects.filter(pk=report.pk).handle(
+                "hidden", handled_by=self.admin
+            )
+        self.assertEqual(sent, [])
+        self.assertEqual(
+            list(OutboxEvent.objects.values_list("signal", flat=True)),
+            ["post_created", "post_report_handled", "post_reports_handled"],
+        )
+
+        # Failures are retried later
+        stdout = io.StringIO()
+        call_command("tinyforum_outbox", stdout=stdout)
+        self.assertEqual(stdout.getvalue(), "Delivered 2 events, 1 failed.\n")
+        self.assertEqual(
+            [(signal, kwargs["request"]) for signal, kwargs in sent],
+            [(post_created, None), (post_reports_handled, None)],
+        )
+        self.assertEqual(sent[0][1]["instance"], t.posts.latest("pk"))
+        self.assertEqual(sent[1][1]["instances"], [report])
+        event = OutboxEvent.objects.get()
+        self.assertEqual(event.attempts, 1)
+        self.assertEqual(event.last_error, "Exception('Boom')")
+        self.assertGreater(event.available_at, timezone.now())
+        self.assertEqual(str(event), "post_report_handled: [%s]" % report.pk)
+
+        # Events of deleted instances are dropped
+        with override_settings(TINYFORUM_OUTBOX=True):
+            send("post_created", instance=Post(pk=0), form=None, request=None)
+        stdout = io.StringIO()
+        call_command("tinyforum_outbox", stdout=stdout)
+        self.assertEqual(stdout.getvalue(), "Delivered 1 events, 0 failed.\n")
+        self.assertEqual(len(sent), 2)
+
+        stdout = io.StringIO()
+        call_command("tinyforum_outbox", stdout=stdout)
+        self.assertEqual(stdout.getvalue(), "")
+        self.assertEqual(OutboxEvent.objects.count(), 1)
+
+    @override_settings(TINYFORUM_NOTIFICATIONS=True)
+    def test_notifications(self):
+        t = Thread.objects.create(title="One", authored_by=self.user1)
+        t.starred_by.set([self.user1, self.user2, self.admin])
+
+        c = Client()
+        c.force_login(self.user1)
+        c.post(t.get_absolute_url(), {"text": "First"})
+        first = t.posts.get()
+        self.assertEqual(
+            set(Notification.objects.values_list("user", "first_post", "post_count")),
+            {(self.user2.pk, first.pk, 1), (self.admin.pk, first.pk, 1)},
+        )
+
+        # Further posts are coalesced into the pending digest
+        second = Post.objects.create(thread=t, text="Second", authored_by=self.user1)
+        with self.assertNumQueries(2):
+            # Update pending and select new subscribers, nothing to insert
+            Notification.objects.notify(second)
+        c.force_login(self.user2)
+        c.post(t.get_absolute_url(), {"text": "Third"})
+        self.assertEqual(
+            set(Notification.objects.values_list("user", "post_count")),
+            {(self.user2.pk, 2), (self.admin.pk, 3), (self.user1.pk, 1)},
+        )
+
+        Notification.objects.filter(user=self.admin).mark_sent()
+        self.assertEqual(
+            Notification.objects.notify(t.posts.latest("pk"), chunk_size=1), 1
+        )
+        self.assertEqual(Notification.objects.pending().count(), 3)
+        self.assertEqual(Notification.objects.count(), 4)
+        self.assertEqual(
+            str(Notification.objects.filter(user=self.admin).pending().get()),
+            "%s: 1" % t.pk,
+        )
+
+    @override_settings(TINYFORUM_SYNC_INTERVAL=0.01, TINYFORUM_SYNC_MAX_WAIT=1)
+    def test_post_sync(self):
+        t = Thread.objects.create(title="One", authored_by=self.user1)
+        p1 = Post.objects.create(thread=t, text="First", authored_by=self.user1)
+        url = reverse("tinyforum:post-sync", kwargs={"pk": t.pk})
+
+        c = Client()
+        response = c.get(url)
+        self.assertEqual(
+            response.json(),
+            {
+                "thread": t.pk,
+                "posts": [
+                    {
+                        "id": p1.pk,
+                        "author": "user1",
+                        "created_at": DjangoJSONEncoder().default(p1.created_at),
+                        "text": "First",
+                    }
+                ],
+                "after": p1.pk,
+            },
+        )
+
+        with self.assertNumQueries(1):
+            # Nothing new, only the thread is checked
+            response = c.get(url, {"after": p1.pk})
+        self.assertEqual(response.json()["posts"], [])
+        self.assertEqual(response.json()["after"], p1.pk)
+
+        p2 = Post.objects.create(thread=t, text="Second", authored_by=self.user2)
+        Post.objects.create(
+            thread=t, text="Hidden", authored_by=self.user2, moderation_status="hidden"
+        )
+        response = c.get(url, {"after": p1.pk})
+        self.assertEqual([p["id"] for p in response.json()["posts"]], [p2.pk])
+
+        since = p1.created_at.replace(tzinfo=None).isoformat()
+        response = c.get(url, {"since": since})
+        self.assertEqual([p["id"] for p in response.json()["posts"]], [p2.pk])
+        with override_settings(USE_TZ=True, TIME_ZONE="UTC"):
+            response = c.get(url, {"since": since})
+        self.assertEqual([p["id"] for p in response.json()["posts"]], [p2.pk])
+        since = timezone.make_aware(timezone.now()).isoformat()
+        response = c.get(url, {"since": since, "wait": 0.03})
+        self.assertEqual(response.json()["posts"], [])
+
+        # Posts are returned in the order of the "after" cursor
+        p3 = Post.objects.create(thread=t, text="Third", authored_by=self.user2)
+        Post.objects.filter(pk=p3.pk).update(created_at=p1.created_at)
+        response = c.get(url, {"after": p1.pk})
+        self.assertEqual([p["id"] for p in response.json()["posts"]], [p2.pk, p3.pk])
+        self.assertEqual(response.json()["after"], p3.pk)
+
+        # Negative waits do not wait at all
+        response = c.get(url, {"after": p3.pk, "wait": -5})
+        self.assertEqual(response.json()["posts"], [])
+
+        # Waiting is disabled by default
+        del settings.TINYFORUM_SYNC_MAX_WAIT
+        with self.assertNumQueries(1):
+            response = c.get(url, {"after": p3.pk, "wait": 25})
+        self.assertEqual(response.json()["posts"], [])
+
+        self.assertEqual(c.get(url, {"after": "abc"}).status_code, 400)
+        self.assertEqual(c.get(url, {"wait": "nan"}).status_code, 400)
+        self.assertEqual(c.get(url, {"wait": "inf"}).status_code, 400)
+        t.moderation_status = t.HIDDEN
+        t.save()
+        self.assertEqual(c.get(url).status_code, 404)
+
+    def test_metrics(self):
+        reset()
+        t = Thread.objects.create(title="One", authored_by=self.user1)
+        c = Client()
+        c.force_login(self.user1)
+        c.post(t.get_absolute_url(), {"text": "<p>Hi</p>"})
+        c.get(t.get_absolute_url())
+        # Disabled, nothing measured
+        self.assertEqual(c.get("/metrics/").status_code, 404)
+        self.assertNotIn("operation=", prometheus_text())
+
+        measured = []
+
+        def receiver(**kwargs):
+            measured.append((kwargs["name"], kwargs["queries"]))
+
+        operation_measured.connect(receiver)
+        try:
+            with override_settings(TINYFORUM_METRICS=True):
+                with self.assertNumQueries(4):
+                    # Session, user, thread and posts. All of them are
+                    # measured as part of the view, request.user is lazy
+                    c.get(t.get_absolute_url())
+                c.post(t.get_absolute_url(), {"text": "<p>Hello</p>"})
+                Thread.objects.recount()
+        finally:
+            operation_measured.disconnect(receiver)
+
+        self.assertEqual(
+            measured[:2],
+            [("template:tinyforum/post_list.html", 0), ("view:post_list", 4)],
+        )
+        self.assertEqual(
+            {name for name, queries in measured},
+            {
+                "template:tinyforum/post_list.html",
+                "view:post_list",
+                "model:Post.sanitize",
+                "model:Post.update_thread",
+                "model:Post.save",
+                "model:Thread.recount",
+            },
+        )
+
+        record('a"b\\', queries=2, db_time=0.5, wall_time=1.5)
+        with override_settings(TINYFORUM_METRICS=True, TINYFORUM_METRICS_TOKEN="t"):
+            self.assertEqual(c.get("/metrics/").status_code, 403)
+            self.assertEqual(
+                Client()
+                .get("/metrics/", HTTP_AUTHORIZATION="Bearer wrong")
+                .status_code,
+                403,
+            )
+            response = Client().get("/metrics/", HTTP_AUTHORIZATION="Bearer t")
+            c.force_login(self.admin)
+            self.assertEqual(c.get("/metrics/").status_code, 200)
+        self.assertEqual(
+            response["content-type"], "text/plain; version=0.0.4; charset=utf-8"
+        )
+        content = response.content.decode()
+        self.assertIn("# TYPE tinyforum_queries_total counter\n", content)
+        self.assertIn(
+            'tinyforum_operations_total{operation="view:post_list"} 2', content
+        )
+        self.assertIn('tinyforum_queries_total{operation="a\\"b\\\\"} 2', content)
+        self.assertIn('tinyforum_seconds_total{operation="a\\"b\\\\"} 1.5', content)
+        reset()
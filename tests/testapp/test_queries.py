@@ -0,0 +1,283 @@
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import Client, TestCase
+from django.test.utils import CaptureQueriesContext
+
+from tinyforum.cache import get_cache
+from tinyforum.models import Post, PostReport, ReadMarker, Thread
+
+# Queries per request. List views are requested with one and with many rows
+# and have to stay within the same budget. Update the budgets together with
+# changes which need more or fewer queries.
+BUDGETS = {
+    "thread_list": 3,
+    "thread_list_authenticated": 5,
+    "post_list": 3,
+    "post_list_authenticated": 9,
+    "post_list_moderator": 9,
+    "search": 3,
+    "post_sync": 2,
+    "thread_star": 4,
+    "thread_create": 2,
+    "thread_update": 4,
+    "post_update": 4,
+    "post_report": 4,
+    "report_list": 3,
+    "report_queue": 4,
+    "report_claim": 7,
+    "report_claimed": 3,
+    "report_handle": 3,
+    "report_handle_post": 9,
+    "report_post_handle": 8,
+    "report_bulk_handle": 9,
+    "export": 6,
+    "export_forum": 6,
+}
+
+ROWS = 15
+
+
+class QueryBudgetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.moderator = User.objects.create_superuser(
+            "admin", "admin@example.com", "password"
+        )
+        cls.user = User.objects.create_user("user", "user@example.com", "password")
+        cls.thread = Thread.objects.create(title="Thread", authored_by=cls.user)
+        cls.post = Post.objects.create(
+            thread=cls.thread, text="<p>First</p>", authored_by=cls.user
+        )
+
+    def setUp(self):
+        self.authors = 0
+
+    def author(self):
+        # Every row by a different user exposes lazily loaded authors
+        self.authors += 1
+        return User.objects.create_user("author-%s" % self.authors)
+
+    def add_threads(self, count):
+        for _i in range(count):
+            author = self.author()
+            thread = Thread.objects.create(title="Thread", authored_by=author)
+            Post.objects.create(thread=thread, text="<p>Text</p>", authored_by=author)
+            thread.starred_by.add(self.user)
+
+    def add_posts(self, count):
+        for i in range(count):
+            Post.objects.create(
+                thread=self.thread,
+                text="<p>Text</p>",
+                authored_by=self.author(),
+                moderation_status=Post.FLAGGED if i % 2 else Post.GOOD,
+            )
+
+    def add_stars(self, count):
+        for _i in range(count):
+            self.thread.starred_by.add(self.author())
+
+    def add_reports(self, count):
+        for _i in range(count):
+            post = Post.objects.create(
+                thread=self.thread, text="<p>Text</p>", authored_by=self.author()
+            )
+            PostReport.objects.create(
+                post=post, authored_by=self.author(), reason="spam"
+            )
+
+    def add_post_reports(self, count):
+        # Handling hides the post, show it again to recount every time
+        Post.objects.filter(pk=self.post.pk).moderate(Post.GOOD)
+        for _i in range(count):
+            PostReport.objects.create(
+                post=self.post, authored_by=self.author(), reason="spam"
+            )
+
+    def assertQueryBudget(
+        self, name, url, *, user=None, data=None, add_rows=None, method="get"
+    ):
+        client = Client()
+        if user:
+            client.force_login(user)
+
+        for rows in [1, ROWS - 1] if add_rows else [0]:
+            if add_rows:
+                add_rows(rows)
+            # Start cold, caches and read markers would hide queries
+            get_cache().clear()
+            ReadMarker.objects.all().delete()
+            with CaptureQueriesContext(connection) as queries:
+                response = getattr(client, method)(
+                    url, data() if callable(data) else data
+                )
+                if response.streaming:
+                    b"".join(response.streaming_content)
+            self.assertLess(response.status_code, 400)
+            self.assertEqual(
+                len(queries),
+                BUDGETS[name],
+                "%s: %s queries with %s rows\n%s"
+                % (
+                    name,
+                    len(queries),
+                    rows,
+                    "\n".join(query["sql"] for query in queries),
+                ),
+            )
+
+    def test_thread_list(self):
+        self.assertQueryBudget("thread_list", "/", add_rows=self.add_threads)
+
+    def test_thread_list_authenticated(self):
+        self.assertQueryBudget(
+            "thread_list_authenticated",
+            "/",
+            user=self.user,
+            add_rows=self.add_threads,
+        )
+
+    def test_post_list(self):
+        self.assertQueryBudget(
+            "post_list", self.thread.get_absolute_url(), add_rows=self.add_posts
+        )
+
+    def test_post_list_authenticated(self):
+        self.assertQueryBudget(
+            "post_list_authenticated",
+            self.thread.get_absolute_url(),
+            user=self.user,
+            add_rows=self.add_posts,
+        )
+
+    def test_post_list_moderator(self):
+        self.assertQueryBudget(
+            "post_list_moderator",
+            self.thread.get_absolute_url(),
+            user=self.moderator,
+            add_rows=self.add_posts,
+        )
+
+    def test_search(self):
+        self.assertQueryBudget(
+            "search", "/search/", data={"q": "text"}, add_rows=self.add_posts
+        )
+
+    def test_post_sync(self):
+        self.assertQueryBudget(
+            "post_sync",
+            "/%s/sync/" % self.thread.pk,
+            data={"after": 0},
+            add_rows=self.add_posts,
+        )
+
+    def test_thread_star(self):
+        self.assertQueryBudget(
+            "thread_star",
+            "/%s/star/" % self.thread.pk,
+            user=self.user,
+            data={"status": 1},
+            add_rows=self.add_stars,
+        )
+
+    def test_forms(self):
+        self.assertQueryBudget("thread_create", "/create/", user=self.user)
+        self.assertQueryBudget(
+            "thread_update", "/%s/update/" % self.thread.pk, user=self.user
+        )
+        self.assertQueryBudget(
+            "post_update", "/post/%s/update/" % self.post.pk, user=self.user
+        )
+        self.assertQueryBudget(
+            "post_report", "/post/%s/report/" % self.post.pk, user=self.moderator
+        )
+
+    def test_report_list(self):
+        self.assertQueryBudget(
+            "report_list",
+            "/moderation/",
+            user=self.moderator,
+            add_rows=self.add_reports,
+        )
+
+    def test_report_queue(self):
+        self.assertQueryBudget(
+            "report_queue",
+            "/moderation/queue/",
+            user=self.moderator,
+            add_rows=self.add_reports,
+        )
+
+    def test_report_claim(self):
+        self.assertQueryBudget(
+            "report_claim",
+            "/moderation/claim/",
+            user=self.moderator,
+            add_rows=self.add_reports,
+            method="post",
+        )
+
+    def test_report_claimed(self):
+        def add_rows(count):
+            self.add_reports(count)
+            PostReport.objects.claim(self.moderator)
+
+        self.assertQueryBudget(
+            "report_claimed",
+            "/moderation/claim/",
+            user=self.moderator,
+            add_rows=add_rows,
+        )
+
+    def test_report_handle(self):
+        report = PostReport.objects.create(
+            post=self.post, authored_by=self.user, reason="spam"
+        )
+        url = "/moderation/%s/" % report.pk
+        self.assertQueryBudget("report_handle", url, user=self.moderator)
+        self.assertQueryBudget(
+            "report_handle_post",
+            url,
+            user=self.moderator,
+            data={"moderation_status": "hidden"},
+            method="post",
+        )
+
+    def test_report_post_handle(self):
+        self.assertQueryBudget(
+            "report_post_handle",
+            "/moderation/post/%s/" % self.post.pk,
+            user=self.moderator,
+            data={"moderation_status": "hidden"},
+            add_rows=self.add_post_reports,
+            method="post",
+        )
+
+    def test_report_bulk_handle(self):
+        def data():
+            return {
+                "reports": PostReport.objects.filter(
+                    handled_at__isnull=True
+                ).values_list("pk", flat=True),
+                "moderation_status": "hidden",
+            }
+
+        self.assertQueryBudget(
+            "report_bulk_handle",
+            "/moderation/bulk/",
+            user=self.moderator,
+            data=data,
+            add_rows=self.add_reports,
+            method="post",
+        )
+
+    def test_export(self):
+        self.assertQueryBudget(
+            "export", "/export/", user=self.user, add_rows=self.add_threads
+        )
+        self.assertQueryBudget(
+            "export_forum",
+            "/moderation/export/",
+            user=self.moderator,
+            add_rows=self.add_threads,
+        )
@@ -1,3 +1,4 @@
+import django
 from django.conf.urls import include, url
 from django.contrib import admin
 
@@ -10,3 +11,6 @@ urlpatterns = [
     url(r"^accounts/", include("django.contrib.auth.urls")),
     url(r"", include("testapp.forum_urls")),
 ]
+
+if django.VERSION >= (3, 1):
+    urlpatterns.insert(-1, url(r"^async/", include("testapp.async_urls")))
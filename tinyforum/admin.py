@@ -1,6 +1,59 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.contrib.auth import get_user_model
+from django.db.models import Q
+from django.utils.text import capfirst
+from django.utils.translation import gettext_lazy as _
 
 from tinyforum import models
+from tinyforum.purge import purge
+from tinyforum.search import post_matches, thread_matches
+
+
+def moderate_posts(moderation_status):
+    def action(modeladmin, request, queryset):
+        count = queryset.moderate(moderation_status)
+        modeladmin.message_user(
+            request, _("Updated %s posts.") % count, messages.SUCCESS
+        )
+
+    action.__name__ = "moderate_posts_%s" % moderation_status
+    action.short_description = capfirst(
+        dict(models.Post.MODERATION_ACTION_CHOICES)[moderation_status]
+    )
+    return action
+
+
+def handle_reports(moderation_status):
+    def action(modeladmin, request, queryset):
+        reports = queryset.handle(
+            moderation_status, handled_by=request.user, request=request
+        )
+        modeladmin.message_user(
+            request, _("Handled %s reports.") % len(reports), messages.SUCCESS
+        )
+
+    action.__name__ = "handle_reports_%s" % moderation_status
+    action.short_description = capfirst(
+        dict(models.PostReport.MODERATION_ACTION_CHOICES)[moderation_status]
+    )
+    return action
+
+
+def purge_authors(modeladmin, request, queryset):
+    # Only hides content, deleting is left to the tinyforum_purge command
+    # because admin actions do not ask for confirmation
+    counts = purge(
+        get_user_model()._default_manager.filter(pk__in=queryset.values("authored_by")),
+        handled_by=request.user,
+    )
+    modeladmin.message_user(
+        request,
+        _("Hid %(threads)s threads, %(posts)s posts and %(reports)s reports.") % counts,
+        messages.SUCCESS,
+    )
+
+
+purge_authors.short_description = _("hide all content of the authors")
 
 
 @admin.register(models.Thread)
@@ -14,13 +67,21 @@ class ThreadAdmin(admin.ModelAdmin):
         "closed_at",
         "moderation_status",
     )
+    actions = [purge_authors]
     list_filter = ("is_pinned", "moderation_status")
     radio_fields = {"moderation_status": admin.HORIZONTAL}
     # starred_by/m2m is unusable with raw_id_fields, but it prevents loading
     # all users into a single list in the admin form.
-    raw_id_fields = ("authored_by", "latest_post", "starred_by")
+    raw_id_fields = ("authored_by", "starred_by")
+    # Maintained by Post.save and the tinyforum_recount management command.
+    readonly_fields = models.Thread.COUNTER_FIELDS
     search_fields = ("title",)
 
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term:
+            return queryset, False
+        return queryset.filter(thread_matches(search_term)), False
+
 
 @admin.register(models.Post)
 class PostAdmin(admin.ModelAdmin):
@@ -32,15 +93,37 @@ class PostAdmin(admin.ModelAdmin):
         "created_at",
         "moderation_status",
     )
+    actions = [
+        moderate_posts(models.Post.GOOD),
+        moderate_posts(models.Post.HIDDEN),
+        purge_authors,
+    ]
     list_filter = ("moderation_status",)
     ordering = ["-created_at"]
     radio_fields = {"moderation_status": admin.HORIZONTAL}
     raw_id_fields = ("thread", "authored_by")
     search_fields = ("thread__title", "text")
 
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term:
+            return queryset, False
+        return (
+            queryset.filter(
+                post_matches(search_term)
+                | Q(
+                    thread__in=models.Thread.objects.filter(thread_matches(search_term))
+                )
+            ),
+            False,
+        )
+
 
 @admin.register(models.PostReport)
 class PostReportAdmin(admin.ModelAdmin):
+    actions = [
+        handle_reports(models.PostReport.GOOD),
+        handle_reports(models.PostReport.HIDDEN),
+    ]
     list_display = (
         "post",
         "reason",
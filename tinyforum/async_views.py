@@ -0,0 +1,38 @@
+"""
+Async variants of the read views for ASGI deployments
+
+Django's ORM has no async interface in the Django versions supported here,
+so these views run the sync view in a thread of the executor instead of the
+single thread which serves all sync views under ASGI. Requests for
+different pages are processed concurrently that way. Every thread uses its
+own database connection.
+"""
+
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+
+from tinyforum import views
+
+
+def _in_thread(view):
+    def run(request, *args, **kwargs):
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            close_old_connections()
+
+    @wraps(view)
+    async def async_view(request, *args, **kwargs):
+        return await sync_to_async(run, thread_sensitive=False)(
+            request, *args, **kwargs
+        )
+
+    return async_view
+
+
+thread_list = _in_thread(views.thread_list)
+post_list = _in_thread(views.post_list)
+thread_star = _in_thread(views.thread_star)
+post_sync = _in_thread(views.post_sync)
@@ -0,0 +1,145 @@
+import time
+from functools import wraps
+from hashlib import md5
+
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.core.cache import caches
+from django.utils.translation import get_language
+
+# Included in all page cache keys, bumped when many threads change at once
+GENERATION_VERSION_KEY = "tinyforum-version"
+THREAD_LIST_VERSION_KEY = "tinyforum-version-threads"
+
+
+def get_cache():
+    return caches[getattr(settings, "TINYFORUM_CACHE", "default")]
+
+
+def _star_key(user, thread_id):
+    return "tinyforum-star-%s-%s" % (user.pk, thread_id)
+
+
+def starred_thread_ids(user, thread_ids):
+    """
+    Return the subset of ``thread_ids`` starred by ``user``
+
+    Only looks at the passed thread IDs, not at all starred threads of the
+    user. Cache misses are resolved using a single query.
+    """
+    cache = get_cache()
+    keys = {_star_key(user, thread_id): thread_id for thread_id in thread_ids}
+    status = {keys[key]: value for key, value in cache.get_many(keys).items()}
+    missing = set(keys.values()) - set(status)
+    if missing:
+        starred = set(
+            user.starred_threads.filter(id__in=missing).values_list("id", flat=True)
+        )
+        status.update((thread_id, thread_id in starred) for thread_id in missing)
+        cache.set_many(
+            {_star_key(user, thread_id): status[thread_id] for thread_id in missing}
+        )
+    return {thread_id for thread_id, value in status.items() if value}
+
+
+def set_thread_starred(user, thread_id, status):
+    get_cache().set(_star_key(user, thread_id), status)
+
+
+def _read_marker_key(user, thread_id):
+    return "tinyforum-read-%s-%s" % (user.pk, thread_id)
+
+
+def get_read_marker(user, thread_id):
+    return get_cache().get(_read_marker_key(user, thread_id))
+
+
+def set_read_marker(user, thread_id, post_count):
+    get_cache().set(_read_marker_key(user, thread_id), post_count)
+
+
+def page_cache_enabled():
+    return getattr(settings, "TINYFORUM_CACHE_PAGES", False)
+
+
+def thread_version_key(thread_id):
+    return "tinyforum-version-thread-%s" % thread_id
+
+
+def _initial_version():
+    # Do not restart at a low number after the key has been evicted from
+    # the cache, pages cached with the old version would be valid again
+    return int(time.time() * 1000)
+
+
+def get_versions(keys):
+    cache = get_cache()
+    versions = cache.get_many(keys)
+    missing = {key: _initial_version() for key in keys if key not in versions}
+    if missing:
+        cache.set_many(missing, timeout=None)
+        versions.update(missing)
+    return [versions[key] for key in keys]
+
+
+def bump_versions(keys):
+    if not page_cache_enabled():
+        return
+    cache = get_cache()
+    for key in keys:
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _initial_version(), timeout=None)
+
+
+def bump_thread_versions(thread_id):
+    """
+    Invalidate cached pages of the thread and the thread list
+    """
+    bump_versions([thread_version_key(thread_id), THREAD_LIST_VERSION_KEY])
+
+
+def cache_anonymous_page(version_keys):
+    """
+    Cache the responses of a view for anonymous users
+
+    Pages of logged-in users contain personal content such as stars and the
+    post form and are never cached. ``version_keys`` receives the view
+    arguments and returns the keys of version numbers the page depends on.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def cached_view(request, *args, **kwargs):
+            if (
+                not page_cache_enabled()
+                or request.method != "GET"
+                or request.user.is_authenticated
+                or get_messages(request)
+            ):
+                return view(request, *args, **kwargs)
+
+            cache = get_cache()
+            keys = [GENERATION_VERSION_KEY] + version_keys(request, *args, **kwargs)
+            # The URL includes the host, pages are rendered in the active
+            # language (e.g. selected by LocaleMiddleware)
+            page = "%s %s" % (request.build_absolute_uri(), get_language())
+            key = "tinyforum-page-%s-%s" % (
+                md5(page.encode("utf-8")).hexdigest(),
+                "-".join(str(version) for version in get_versions(keys)),
+            )
+            response = cache.get(key)
+            if response is None:
+                response = view(request, *args, **kwargs)
+                if response.status_code == 200:
+                    cache.set(
+                        key,
+                        response,
+                        timeout=getattr(settings, "TINYFORUM_CACHE_PAGES_TIMEOUT", 300),
+                    )
+            return response
+
+        return cached_view
+
+    return decorator
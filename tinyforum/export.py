@@ -0,0 +1,130 @@
+"""
+Streaming export of threads, posts, reports and stars
+
+Records are read using ``.iterator(chunk_size=...)``, which uses server-side
+cursors where the database supports them, and written one JSON line at a
+time, so memory use does not depend on the size of the forum. Every thread
+is followed by its posts, reports and stars follow at the end. The export of
+the whole forum can be loaded using ``tinyforum_import``.
+"""
+
+import json
+import zipfile
+
+from django.contrib.auth import get_user_model
+from django.core.serializers.json import DjangoJSONEncoder
+
+from tinyforum.models import Post, PostReport, Thread
+
+CHUNK_SIZE = 2000
+
+
+def _author(prefix="authored_by"):
+    return "%s__%s" % (prefix, get_user_model().USERNAME_FIELD)
+
+
+def _records(type, queryset, fields, chunk_size):
+    author = _author()
+    for row in queryset.values(*fields, author).iterator(chunk_size=chunk_size):
+        row["author"] = row.pop(author)
+        yield {"type": type, **row}
+
+
+def export_records(user=None, *, chunk_size=CHUNK_SIZE):
+    """
+    Yield the records of the whole forum or only those of ``user``
+    """
+    threads = Thread.objects.order_by("pk")
+    # "thread" would order by Thread.Meta.ordering, not by the thread's ID.
+    # The foreign key index serves this order, the partial index on
+    # (thread, created_at, id) only contains visible posts.
+    posts = Post.objects.order_by("thread_id", "pk")
+    reports = PostReport.objects.order_by("pk")
+    stars = Thread.starred_by.through.objects.order_by("pk")
+    if user is not None:
+        threads = threads.filter(authored_by=user)
+        posts = posts.filter(authored_by=user)
+        reports = reports.filter(authored_by=user)
+        stars = stars.filter(user=user)
+
+    threads = _records(
+        "thread",
+        threads,
+        ["id", "title", "created_at", "closed_at", "is_pinned", "moderation_status"],
+        chunk_size,
+    )
+    thread = next(threads, None)
+    for post in _records(
+        "post",
+        posts,
+        ["id", "thread", "text", "created_at", "moderation_status"],
+        chunk_size,
+    ):
+        # Both are ordered by thread, emit threads up to the post's thread
+        while thread is not None and thread["id"] <= post["thread"]:
+            yield thread
+            thread = next(threads, None)
+        yield post
+    while thread is not None:
+        yield thread
+        thread = next(threads, None)
+
+    yield from _records(
+        "report",
+        reports,
+        [
+            "id",
+            "post",
+            "reason",
+            "notes",
+            "created_at",
+            "moderation_status",
+            "handled_at",
+        ],
+        chunk_size,
+    )
+    username = _author("user")
+    for star in stars.values("thread", username).iterator(chunk_size=chunk_size):
+        yield {"type": "star", "thread": star["thread"], "user": star[username]}
+
+
+def jsonl(records):
+    """
+    Encode records as JSON lines
+    """
+    for record in records:
+        yield (json.dumps(record, cls=DjangoJSONEncoder) + "\n").encode("utf-8")
+
+
+class _Buffer:
+    # Write-only file for ZipFile, the stream does not have to be seekable
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def zipped(lines, *, name="forum.jsonl"):
+    """
+    Compress ``lines`` into a ZIP archive containing the single file ``name``
+    and yield the archive incrementally
+    """
+    buffer = _Buffer()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        with archive.open(name, "w", force_zip64=True) as f:
+            for line in lines:
+                f.write(line)
+                data = buffer.pop()
+                if data:
+                    yield data
+    yield buffer.pop()
@@ -3,7 +3,7 @@ from django.utils import timezone
 from django.utils.text import capfirst
 from django.utils.translation import gettext_lazy as _
 
-from tinyforum import signals
+from tinyforum import outbox
 from tinyforum.models import Post, PostReport, Thread
 
 
@@ -121,11 +121,10 @@ class CreatePostForm(BasePostForm, forms.ModelForm):
         model = Post
         fields = ("text",)
 
+    @outbox.atomic
     def save(self):
         instance = super().save()
-        signals.post_created.send(
-            sender=Post, instance=instance, form=self, request=self.request
-        )
+        outbox.send("post_created", instance=instance, form=self, request=self.request)
         return instance
 
 
@@ -203,6 +202,7 @@ class HandlePostReportForm(BaseForm, forms.ModelForm):
         model = PostReport
         fields = ("moderation_status",)
 
+    @outbox.atomic
     def save(self):
         instance = super().save(commit=False)
         instance.handled_at = timezone.now()
@@ -210,7 +210,51 @@ class HandlePostReportForm(BaseForm, forms.ModelForm):
         instance.save()
         instance.post.moderation_status = instance.moderation_status
         instance.post.save()
-        signals.post_report_handled.send(
-            sender=PostReport, instance=instance, form=self, request=self.request
+        outbox.send(
+            "post_report_handled", instance=instance, form=self, request=self.request
         )
         return instance
+
+
+class BulkHandlePostReportForm(BaseForm):
+    reports = forms.ModelMultipleChoiceField(
+        queryset=PostReport.objects.none(), widget=forms.CheckboxSelectMultiple
+    )
+    moderation_status = forms.ChoiceField(
+        label=capfirst(_("moderation status")),
+        choices=PostReport.MODERATION_ACTION_CHOICES,
+        widget=forms.RadioSelect,
+    )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields["reports"].queryset = PostReport.objects.available(
+            self.request.user
+        )
+
+    def save(self):
+        return self.cleaned_data["reports"].handle(
+            self.cleaned_data["moderation_status"],
+            handled_by=self.request.user,
+            request=self.request,
+        )
+
+
+class HandlePostReportsForm(BaseForm):
+    moderation_status = forms.ChoiceField(
+        label=capfirst(_("moderation status")),
+        choices=PostReport.MODERATION_ACTION_CHOICES,
+        widget=forms.RadioSelect,
+    )
+
+    def __init__(self, *args, **kwargs):
+        self.post = kwargs.pop("post")
+        super().__init__(*args, **kwargs)
+
+    def save(self):
+        reports = self.post.reports.available(self.request.user)
+        return reports.handle(
+            self.cleaned_data["moderation_status"],
+            handled_by=self.request.user,
+            request=self.request,
+        )
@@ -0,0 +1,191 @@
+"""
+Live updates of threads using server-sent events
+
+Django versions supported here cannot stream responses asynchronously, so
+the event stream is a small ASGI application which wraps the Django ASGI
+application in the project's ``asgi.py``::
+
+    from django.core.asgi import get_asgi_application
+    from tinyforum.live import live_events
+
+    application = live_events(get_asgi_application(), prefix="/forum/")
+
+``GET /forum/<pk>/events/`` then streams ``post``, ``edit`` and ``hide``
+events of the thread. Idle connections only cost a queue, no thread and no
+database connection. Events are published by ``Post.save`` after the
+transaction commits and distributed by the broker configured using
+``TINYFORUM_LIVE_BROKER`` (defaults to the in-process ``LocalBroker``).
+Clients which missed events catch up using the ``post_sync`` view.
+"""
+
+import asyncio
+import json
+import re
+from collections import defaultdict
+from functools import lru_cache
+
+from django.apps import apps
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections, transaction
+from django.utils.module_loading import import_string
+
+
+class LocalBroker:
+    """
+    Distribute events to subscribers in the same process
+
+    ``publish`` may be called from any thread, subscribers are queues of
+    the event loop which created them. Events for subscribers which do not
+    keep up are dropped. Brokers which cannot tell whether a thread has
+    subscribers should always return ``True`` from ``has_subscribers``.
+    """
+
+    def __init__(self, *, maxsize=100):
+        self.maxsize = maxsize
+        self.subscribers = defaultdict(set)
+
+    def subscribe(self, thread_id):
+        queue = asyncio.Queue(maxsize=self.maxsize)
+        self.subscribers[thread_id].add((asyncio.get_event_loop(), queue))
+        return queue
+
+    def unsubscribe(self, thread_id, queue):
+        subscribers = self.subscribers[thread_id]
+        subscribers.difference_update({s for s in subscribers if s[1] is queue})
+        if not subscribers:
+            del self.subscribers[thread_id]
+
+    def has_subscribers(self, thread_id):
+        return thread_id in self.subscribers
+
+    def publish(self, thread_id, event):
+        for loop, queue in list(self.subscribers.get(thread_id, ())):
+            loop.call_soon_threadsafe(self._put, queue, event)
+
+    def _put(self, queue, event):
+        if not queue.full():
+            queue.put_nowait(event)
+
+
+@lru_cache(maxsize=None)
+def get_broker():
+    return import_string(
+        getattr(settings, "TINYFORUM_LIVE_BROKER", "tinyforum.live.LocalBroker")
+    )()
+
+
+def publish(thread_id, event):
+    """
+    Publish ``event`` after the current transaction has been committed
+    """
+    broker = get_broker()
+    if broker.has_subscribers(thread_id):
+        transaction.on_commit(lambda: broker.publish(thread_id, event))
+
+
+def publish_post(post, *, was_visible):
+    """
+    Publish the ``post``, ``edit`` or ``hide`` event for a saved post
+    """
+    if not get_broker().has_subscribers(post.thread_id):
+        return
+    if post.moderation_status != post.HIDDEN:
+        event = {
+            "type": "edit" if was_visible else "post",
+            "id": post.pk,
+            "author": str(post.authored_by),
+            "created_at": post.created_at,
+            "text": post.text,
+        }
+    elif was_visible:
+        event = {"type": "hide", "id": post.pk}
+    else:
+        return
+    publish(post.thread_id, event)
+
+
+def _format(event):
+    return (
+        "event: %s\ndata: %s\n\n"
+        % (
+            event["type"],
+            json.dumps(event, cls=DjangoJSONEncoder),
+        )
+    ).encode("utf-8")
+
+
+def _thread_exists(pk):
+    try:
+        threads = apps.get_model("tinyforum", "Thread").objects.visible()
+        return threads.filter(pk=pk).exists()
+    finally:
+        close_old_connections()
+
+
+async def stream(scope, receive, send, *, thread_id):
+    """
+    ASGI application streaming the events of a thread
+    """
+    # Django 2.2 does not depend on asgiref, importing tinyforum.models
+    # (which publishes events) has to work without it
+    from asgiref.sync import sync_to_async
+
+    if not await sync_to_async(_thread_exists, thread_sensitive=False)(thread_id):
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 404,
+                "headers": [(b"content-type", b"text/plain")],
+            }
+        )
+        await send({"type": "http.response.body", "body": b"Not found"})
+        return
+
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream"),
+                (b"cache-control", b"no-cache"),
+            ],
+        }
+    )
+    broker = get_broker()
+    queue = broker.subscribe(thread_id)
+    disconnect = asyncio.ensure_future(receive())
+    keepalive = getattr(settings, "TINYFORUM_LIVE_KEEPALIVE", 15)
+    try:
+        while True:
+            event = asyncio.ensure_future(queue.get())
+            done, pending = await asyncio.wait(
+                {event, disconnect},
+                timeout=keepalive,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if event not in done:
+                event.cancel()
+            if disconnect in done:
+                break
+            body = _format(event.result()) if event in done else b": keepalive\n\n"
+            await send({"type": "http.response.body", "body": body, "more_body": True})
+    finally:
+        broker.unsubscribe(thread_id, queue)
+        disconnect.cancel()
+
+
+def live_events(application, *, prefix="/"):
+    """
+    Wrap an ASGI application and serve ``<prefix><pk>/events/`` using
+    ``stream``
+    """
+    pattern = re.compile(r"^%s(?P<pk>[0-9]+)/events/$" % re.escape(prefix))
+
+    async def app(scope, receive, send):
+        match = scope["type"] == "http" and pattern.match(scope["path"])
+        if match:
+            return await stream(scope, receive, send, thread_id=int(match.group("pk")))
+        return await application(scope, receive, send)
+
+    return app
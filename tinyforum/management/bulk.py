@@ -0,0 +1,29 @@
+from django.db import connection
+from django.db.models import Max
+
+
+def max_pk(model):
+    return model._default_manager.aggregate(pk=Max("pk"))["pk"] or 0
+
+
+def bulk_create(model, objs, *, batch_size=None):
+    """
+    ``bulk_create`` which sets primary keys on all backends
+
+    Backends which cannot return the primary keys of inserted rows get the
+    new rows' keys from the database, so call this in a transaction without
+    concurrent inserts into the same table.
+    """
+    manager = model._default_manager
+    if connection.features.can_return_rows_from_bulk_insert:
+        return manager.bulk_create(objs, batch_size=batch_size)  # pragma: no cover
+
+    start = max_pk(model)
+    manager.bulk_create(objs, batch_size=batch_size)
+    pks = manager.filter(pk__gt=start).order_by("pk").values_list("pk", flat=True)
+    count = len(objs)
+    for obj, pk in zip(objs, pks[:count]):
+        obj.pk = pk
+        obj._state.adding = False
+        obj._state.db = manager.db
+    return objs
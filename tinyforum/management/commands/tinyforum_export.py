@@ -0,0 +1,41 @@
+import sys
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from tinyforum.export import CHUNK_SIZE, export_records, jsonl, zipped
+
+
+class Command(BaseCommand):
+    help = "Export threads, posts, reports and stars as JSON Lines or ZIP."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "path", nargs="?", default="-", help='The output file, "-" for stdout.'
+        )
+        parser.add_argument("--user", help="Only export the data of this user.")
+        parser.add_argument("--format", choices=["jsonl", "zip"], default="jsonl")
+        parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+
+    def handle(self, **options):
+        user = None
+        if options["user"]:
+            User = get_user_model()
+            try:
+                user = User._default_manager.get_by_natural_key(options["user"])
+            except User.DoesNotExist:
+                raise CommandError("Unknown user %r" % options["user"])
+
+        data = jsonl(export_records(user, chunk_size=options["chunk_size"]))
+        if options["format"] == "zip":
+            data = zipped(data)
+
+        if options["path"] == "-":
+            self.write(sys.stdout.buffer, data)
+        else:
+            with open(options["path"], "wb") as f:
+                self.write(f, data)
+
+    def write(self, f, data):
+        for chunk in data:
+            f.write(chunk)
@@ -0,0 +1,229 @@
+import random
+from datetime import timedelta
+from itertools import accumulate
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from tinyforum.management.bulk import bulk_create, max_pk
+from tinyforum.models import Post, PostReport, Thread
+from tinyforum.search import index_posts, index_threads
+
+WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod"
+    " tempor incididunt ut labore et dolore magna aliqua enim ad minim veniam"
+    " quis nostrud exercitation ullamco laboris nisi aliquip ex ea commodo"
+).split()
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate a synthetic forum with users, threads, posts, stars and"
+        " reports for performance testing."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument("--threads", type=int, default=1000)
+        parser.add_argument(
+            "--posts",
+            type=float,
+            default=20,
+            help="Average number of posts per thread.",
+        )
+        parser.add_argument("--max-posts", type=int, default=5000)
+        parser.add_argument(
+            "--alpha",
+            type=float,
+            default=1.5,
+            help="Shape of the Pareto distribution of posts per thread.",
+        )
+        parser.add_argument(
+            "--stars", type=float, default=5, help="Average stars per user."
+        )
+        parser.add_argument(
+            "--reports", type=float, default=0.005, help="Ratio of reported posts."
+        )
+        parser.add_argument("--hidden", type=float, default=0.02)
+        parser.add_argument("--flagged", type=float, default=0.01)
+        parser.add_argument("--closed", type=float, default=0.1)
+        parser.add_argument("--days", type=int, default=365)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, **options):
+        if options["alpha"] <= 1:
+            raise CommandError("--alpha has to be greater than 1.")
+        if options["users"] < 1 or options["threads"] < 1:
+            raise CommandError("--users and --threads have to be positive.")
+
+        self.random = random.Random(options["seed"])
+        self.options = options
+        self.now = timezone.now()
+
+        with transaction.atomic():
+            users = self.create_users()
+            threads = self.create_threads(users)
+            posts = self.create_posts(users, threads)
+            Thread.objects.filter(pk__in=[thread.pk for thread in threads]).recount()
+            stars = self.create_stars(users, threads)
+            reports = self.create_reports(users, posts)
+            self.index(threads, posts)
+
+        self.stdout.write(
+            "Generated %s users, %s threads, %s posts, %s stars and %s reports."
+            % (len(users["pks"]), len(threads), len(posts), stars, reports)
+        )
+
+    def moderation_status(self):
+        value = self.random.random()
+        if value < self.options["hidden"]:
+            return Post.HIDDEN
+        elif value < self.options["hidden"] + self.options["flagged"]:
+            return Post.FLAGGED
+        return Post.GOOD
+
+    def text(self):
+        return "<p>%s</p>" % " ".join(
+            self.random.choices(WORDS, k=self.random.randint(5, 80))
+        )
+
+    def create_users(self):
+        User = get_user_model()
+        start = max_pk(User)
+        password = make_password(None)
+        users = bulk_create(
+            User,
+            [
+                User(
+                    password=password,
+                    **{User.USERNAME_FIELD: "forum-%s-%s" % (start, i)}
+                )
+                for i in range(self.options["users"])
+            ],
+            batch_size=self.options["batch_size"],
+        )
+        pks = [user.pk for user in users]
+        # Few users write most of the posts
+        return {
+            "pks": pks,
+            "cum_weights": list(accumulate(1 / (i + 1) for i in range(len(pks)))),
+        }
+
+    def authors(self, users, count):
+        return self.random.choices(
+            users["pks"], cum_weights=users["cum_weights"], k=count
+        )
+
+    def create_threads(self, users):
+        days = self.options["days"]
+        threads = []
+        for author in self.authors(users, self.options["threads"]):
+            created_at = self.now - timedelta(days=self.random.uniform(0, days))
+            threads.append(
+                Thread(
+                    title=" ".join(self.random.choices(WORDS, k=6)).capitalize(),
+                    authored_by_id=author,
+                    created_at=created_at,
+                    latest_post_at=created_at,
+                    modified_at=created_at,
+                    closed_at=(
+                        created_at
+                        if self.random.random() < self.options["closed"]
+                        else None
+                    ),
+                    moderation_status=(
+                        Thread.HIDDEN
+                        if self.random.random() < self.options["hidden"]
+                        else Thread.GOOD
+                    ),
+                )
+            )
+        return bulk_create(Thread, threads, batch_size=self.options["batch_size"])
+
+    def post_count(self):
+        # Scale the Pareto distribution (mean alpha / (alpha - 1)) to the
+        # requested average
+        alpha = self.options["alpha"]
+        count = self.random.paretovariate(alpha) * self.options["posts"]
+        return max(
+            1, min(self.options["max_posts"], round(count * (alpha - 1) / alpha))
+        )
+
+    def create_posts(self, users, threads):
+        start = max_pk(Post)
+        batch = []
+        for thread in threads:
+            count = thread.post_count = self.post_count()
+            seconds = (self.now - thread.created_at).total_seconds()
+            offsets = sorted(self.random.uniform(0, seconds) for _ in range(count))
+            offsets[0] = 0
+            for offset, author in zip(offsets, self.authors(users, count)):
+                batch.append(
+                    Post(
+                        thread=thread,
+                        authored_by_id=author,
+                        created_at=thread.created_at + timedelta(seconds=offset),
+                        text=self.text(),
+                        moderation_status=self.moderation_status(),
+                    )
+                )
+            if len(batch) >= self.options["batch_size"]:
+                Post.objects.bulk_create(batch)
+                batch = []
+        Post.objects.bulk_create(batch)
+        return list(
+            Post.objects.filter(pk__gt=start)
+            .order_by("pk")
+            .values_list("pk", "authored_by")
+        )
+
+    def create_stars(self, users, threads):
+        Star = Thread.starred_by.through
+        # Long threads collect most stars
+        cum_weights = list(accumulate(thread.post_count for thread in threads))
+        stars = []
+        for user in users["pks"]:
+            count = min(
+                len(threads), round(self.random.expovariate(1) * self.options["stars"])
+            )
+            starred = set(
+                self.random.choices(threads, cum_weights=cum_weights, k=count)
+            )
+            stars.extend(Star(user_id=user, thread_id=thread.pk) for thread in starred)
+        Star.objects.bulk_create(stars, batch_size=self.options["batch_size"])
+        return len(stars)
+
+    def create_reports(self, users, posts):
+        reasons = [reason for reason, _ in PostReport.REASON_CHOICES]
+        reports = []
+        for post, author in posts:
+            if self.random.random() >= self.options["reports"]:
+                continue
+            reporters = set(self.authors(users, self.random.randint(1, 3)))
+            reports.extend(
+                PostReport(
+                    post_id=post,
+                    authored_by_id=user,
+                    reason=self.random.choice(reasons),
+                    created_at=self.now,
+                )
+                for user in reporters - {author}
+            )
+        PostReport.objects.bulk_create(reports, batch_size=self.options["batch_size"])
+        return len(reports)
+
+    def index(self, threads, posts):
+        index_threads(threads)
+        size = self.options["batch_size"]
+        for start in range(0, len(posts), size):
+            stop = start + size
+            chunk = posts[start:stop]
+            index_posts(
+                Post.objects.only("text").filter(
+                    pk__gte=chunk[0][0], pk__lte=chunk[-1][0]
+                )
+            )
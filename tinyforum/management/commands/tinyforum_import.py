@@ -0,0 +1,212 @@
+import json
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from html_sanitizer.django import get_sanitizer
+
+from tinyforum.management.bulk import bulk_create
+from tinyforum.models import Post, Thread
+from tinyforum.search import index_posts, index_threads
+
+
+def sanitize(text):
+    return get_sanitizer("tinyforum-post").sanitize(text)
+
+
+class Command(BaseCommand):
+    help = (
+        "Import threads and posts from a JSON Lines file. Every thread is"
+        ' followed by its posts:\n{"type": "thread", "title": ..., "author":'
+        ' ...}\n{"type": "post", "text": ..., "author": ...}\nOptional fields'
+        ' are "created_at", "moderation_status" and for threads "closed_at"'
+        ' and "is_pinned". Posts are sanitized but no signals are sent.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help='The file to import, "-" for stdin.')
+        parser.add_argument("--chunk-size", type=int, default=500)
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=os.cpu_count(),
+            help="Processes sanitizing posts, 0 sanitizes in this process.",
+        )
+        parser.add_argument(
+            "--create-users",
+            action="store_true",
+            help="Create missing authors instead of failing.",
+        )
+
+    def handle(self, **options):
+        self.options = options
+        # Spawned workers behave the same on all platforms and do not inherit
+        # database connections, but have to set up Django before they can
+        # import this module. Python < 3.7 has no initializer, the default
+        # start method is fork (except on Windows) there.
+        pool_options = (
+            {
+                "mp_context": multiprocessing.get_context("spawn"),
+                "initializer": django.setup,
+            }
+            if sys.version_info >= (3, 7)
+            else {}
+        )
+        self.pool = (
+            ProcessPoolExecutor(options["workers"], **pool_options)
+            if options["workers"]
+            else None
+        )
+        self.threads = self.posts = 0
+        self.first_thread = self.last_thread = None
+        try:
+            if options["path"] == "-":
+                self.read(sys.stdin)
+            else:
+                with open(options["path"], encoding="utf-8") as f:
+                    self.read(f)
+        finally:
+            if self.pool:
+                self.pool.shutdown()
+            # Counters of imported threads are computed once, also when the
+            # import failed after some chunks
+            if self.first_thread is not None:
+                Thread.objects.filter(
+                    pk__gte=self.first_thread, pk__lte=self.last_thread
+                ).recount()
+
+        self.stdout.write(
+            "Imported %s threads and %s posts." % (self.threads, self.posts)
+        )
+
+    def read(self, lines):
+        thread = None
+        chunk = []
+        for lineno, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                if record["type"] == "thread":
+                    thread = self.thread(record)
+                    chunk.append((lineno, record["author"], thread))
+                elif record["type"] == "post":
+                    if thread is None:
+                        raise ValueError("Post without a thread")
+                    chunk.append((lineno, record["author"], self.post(record, thread)))
+                elif record["type"] not in {"report", "star"}:
+                    # Reports and stars written by tinyforum_export are skipped
+                    raise ValueError("Unknown type %r" % record["type"])
+            except (KeyError, TypeError, ValueError) as exc:
+                raise CommandError("Line %s: %r" % (lineno, exc))
+
+            if len(chunk) >= self.options["chunk_size"]:
+                self.flush(chunk)
+                chunk = []
+        self.flush(chunk)
+
+    def datetime(self, value):
+        if value is None:
+            return timezone.now()
+        parsed = parse_datetime(value)
+        if parsed is None:
+            raise ValueError("Invalid date %r" % value)
+        if settings.USE_TZ and timezone.is_naive(parsed):
+            parsed = timezone.make_aware(parsed)
+        return parsed
+
+    def moderation_status(self, record):
+        status = record.get("moderation_status", Post.GOOD)
+        if status not in dict(Post.MODERATION_STATUS_CHOICES):
+            raise ValueError("Invalid moderation status %r" % status)
+        return status
+
+    def thread(self, record):
+        created_at = self.datetime(record.get("created_at"))
+        closed_at = record.get("closed_at")
+        return Thread(
+            title=record["title"],
+            created_at=created_at,
+            latest_post_at=created_at,
+            closed_at=self.datetime(closed_at) if closed_at else None,
+            is_pinned=bool(record.get("is_pinned")),
+            moderation_status=self.moderation_status(record),
+        )
+
+    def post(self, record, thread):
+        return Post(
+            thread=thread,
+            text=record["text"],
+            created_at=self.datetime(record.get("created_at")),
+            moderation_status=self.moderation_status(record),
+        )
+
+    def authors(self, chunk):
+        User = get_user_model()
+        field = User.USERNAME_FIELD
+        names = {author for _, author, _ in chunk}
+        users = dict(
+            User._default_manager.filter(**{"%s__in" % field: names}).values_list(
+                field, "pk"
+            )
+        )
+        missing = names - set(users)
+        if missing and not self.options["create_users"]:
+            lineno = min(lineno for lineno, author, _ in chunk if author in missing)
+            raise CommandError("Line %s: Unknown users %s" % (lineno, sorted(missing)))
+        if missing:
+            password = make_password(None)
+            created = bulk_create(
+                User, [User(password=password, **{field: name}) for name in missing]
+            )
+            users.update((getattr(user, field), user.pk) for user in created)
+        return users
+
+    def flush(self, chunk):
+        if not chunk:
+            return
+
+        posts = [instance for _, _, instance in chunk if isinstance(instance, Post)]
+        texts = [post.text for post in posts]
+        if self.pool:
+            texts = self.pool.map(
+                sanitize,
+                texts,
+                chunksize=max(1, len(texts) // (4 * self.options["workers"])),
+            )
+        else:
+            texts = map(sanitize, texts)
+        for post, text in zip(posts, texts):
+            post.text = text
+
+        with transaction.atomic():
+            users = self.authors(chunk)
+            for _, author, instance in chunk:
+                instance.authored_by_id = users[author]
+
+            threads = [
+                instance for _, _, instance in chunk if isinstance(instance, Thread)
+            ]
+            bulk_create(Thread, threads)
+            for post in posts:
+                # The thread may have been created just now
+                post.thread_id = post.thread.pk
+            bulk_create(Post, posts)
+
+            index_threads(threads)
+            index_posts(posts)
+
+        if threads:
+            self.first_thread = self.first_thread or threads[0].pk
+            self.last_thread = threads[-1].pk
+        self.threads += len(threads)
+        self.posts += len(posts)
@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from tinyforum.outbox import process
+
+
+class Command(BaseCommand):
+    help = "Send the signals of pending outbox events."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100)
+        parser.add_argument("--workers", type=int, default=4)
+        parser.add_argument("--max-attempts", type=int, default=5)
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="Keep running and poll for new events every --interval seconds.",
+        )
+        parser.add_argument("--interval", type=float, default=1)
+
+    def handle(self, **options):
+        while True:
+            delivered, failed = process(
+                batch_size=options["batch_size"],
+                workers=options["workers"],
+                max_attempts=options["max_attempts"],
+            )
+            if delivered or failed:
+                self.stdout.write(
+                    "Delivered %s events, %s failed." % (delivered, failed)
+                )
+            if not options["loop"]:  # pragma: no branch
+                break
+            if delivered + failed < options["batch_size"]:  # pragma: no cover
+                time.sleep(options["interval"])
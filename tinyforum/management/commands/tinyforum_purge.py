@@ -0,0 +1,41 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from tinyforum.purge import purge
+
+
+class Command(BaseCommand):
+    help = (
+        "Hide or delete all threads, posts and reports of users and recount"
+        " the threads they posted in."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("users", nargs="+", help="Usernames.")
+        parser.add_argument(
+            "--delete",
+            action="store_true",
+            help="Delete the content instead of hiding it.",
+        )
+
+    def handle(self, **options):
+        User = get_user_model()
+        field = User.USERNAME_FIELD
+        users = list(
+            User._default_manager.filter(**{"%s__in" % field: options["users"]})
+        )
+        missing = set(options["users"]) - {getattr(user, field) for user in users}
+        if missing:
+            raise CommandError("Unknown users %s" % sorted(missing))
+
+        counts = purge(users, delete=options["delete"])
+        self.stdout.write(
+            "%s %s threads, %s posts and %s reports, recounted %s threads."
+            % (
+                "Deleted" if options["delete"] else "Hid",
+                counts["threads"],
+                counts["posts"],
+                counts["reports"],
+                counts["recounted"],
+            )
+        )
@@ -0,0 +1,73 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils.dateparse import parse_datetime
+
+from tinyforum.cache import GENERATION_VERSION_KEY, bump_versions
+from tinyforum.models import Thread
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the post count and the latest post of threads whose"
+        " counters have drifted."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "threads", nargs="*", type=int, help="Only check these threads."
+        )
+        parser.add_argument(
+            "--modified-since",
+            help="Only check threads modified since this date and time.",
+        )
+        parser.add_argument("--chunk-size", type=int, default=1000)
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Report drifted threads without changing them.",
+        )
+
+    def threads(self, options):
+        threads = Thread.objects.all()
+        if options["threads"]:
+            threads = threads.filter(pk__in=options["threads"])
+        if options["modified_since"]:
+            since = parse_datetime(options["modified_since"])
+            if since is None:
+                raise CommandError("Invalid date %r" % options["modified_since"])
+            threads = threads.filter(modified_at__gte=since)
+        return threads
+
+    def handle(self, **options):
+        threads = self.threads(options)
+        checked = recounted = 0
+        for count, drifted in threads.drifted(chunk_size=options["chunk_size"]):
+            checked += count
+            if options["dry_run"] or options["verbosity"] > 1:
+                for row in drifted:
+                    self.stdout.write(self.describe(row))
+            if drifted and not options["dry_run"]:
+                with transaction.atomic():
+                    recounted += Thread.objects.filter(
+                        pk__in=[row["pk"] for row in drifted]
+                    ).recount(bump=False)
+            elif drifted:
+                recounted += len(drifted)
+
+        if options["dry_run"]:
+            self.stdout.write("%s of %s threads have drifted." % (recounted, checked))
+        else:
+            if recounted:
+                # Once for all chunks, every bump expires all cached pages
+                bump_versions([GENERATION_VERSION_KEY])
+            self.stdout.write("Recounted %s threads." % recounted)
+
+    def describe(self, row):
+        return "Thread %s: %s" % (
+            row["pk"],
+            ", ".join(
+                "%s %s -> %s" % (field, row[field], row["expected_%s" % field])
+                for field in Thread.COUNTER_FIELDS
+                if row[field] != row["expected_%s" % field]
+            ),
+        )
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from tinyforum.models import Post, Thread
+from tinyforum.search import index_posts, index_threads
+
+
+class Command(BaseCommand):
+    help = "Rebuild the full text index of posts and thread titles."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000)
+
+    def handle(self, **options):
+        threads = self.index(Thread.objects.only("title"), index_threads, options)
+        posts = self.index(Post.objects.only("text"), index_posts, options)
+        self.stdout.write("Indexed %s threads and %s posts." % (threads, posts))
+
+    def index(self, queryset, index, options):
+        # Ranges of primary keys instead of OFFSET which has to skip all rows
+        # of the previous chunks
+        queryset = queryset.order_by("pk")
+        count = last = 0
+        while True:
+            chunk = list(queryset.filter(pk__gt=last)[: options["chunk_size"]])
+            if not chunk:
+                return count
+            index(chunk)
+            count += len(chunk)
+            last = chunk[-1].pk
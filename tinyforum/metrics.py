@@ -0,0 +1,140 @@
+"""
+Optional instrumentation of views, model operations and template rendering
+
+With ``TINYFORUM_METRICS = True`` every measured operation records its
+number of queries, the time spent in the database and the wall time.
+Measurements are inclusive, a view's numbers contain the templates it
+renders. The totals of the current process are exported in the Prometheus
+text format by the ``metrics`` view; other sinks connect to the
+``operation_measured`` signal. When disabled, measuring only costs a
+cached settings lookup.
+"""
+
+import threading
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+from time import perf_counter
+
+from django import shortcuts
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import connection
+from django.dispatch import receiver
+
+from tinyforum.signals import operation_measured
+
+_lock = threading.Lock()
+# Operation name: [count, queries, database seconds, wall seconds]
+_totals = {}
+
+METRICS = (
+    ("tinyforum_operations_total", "Number of measured operations."),
+    ("tinyforum_queries_total", "Number of database queries."),
+    ("tinyforum_db_seconds_total", "Time spent in the database."),
+    ("tinyforum_seconds_total", "Wall time of the operations."),
+)
+
+
+@lru_cache(maxsize=None)
+def metrics_enabled():
+    return getattr(settings, "TINYFORUM_METRICS", False)
+
+
+@receiver(setting_changed)
+def _clear_metrics_enabled(*, setting, **kwargs):
+    if setting == "TINYFORUM_METRICS":
+        metrics_enabled.cache_clear()
+
+
+def measure(name):
+    """
+    Measure the block as operation ``name`` if metrics are enabled
+    """
+    return _measure(name) if metrics_enabled() else _disabled()
+
+
+@contextmanager
+def _disabled():
+    # contextlib.nullcontext requires Python 3.7
+    yield
+
+
+@contextmanager
+def _measure(name):
+    queries = 0
+    db_time = 0.0
+
+    def wrapper(execute, sql, params, many, context):
+        nonlocal queries, db_time
+        start = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            queries += 1
+            db_time += perf_counter() - start
+
+    start = perf_counter()
+    try:
+        with connection.execute_wrapper(wrapper):
+            yield
+    finally:
+        record(name, queries=queries, db_time=db_time, wall_time=perf_counter() - start)
+
+
+def instrument(name):
+    """
+    Decorator measuring every call of the function as operation ``name``
+    """
+
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not metrics_enabled():
+                return fn(*args, **kwargs)
+            with _measure(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def render(request, template_name, context=None, **kwargs):
+    """
+    ``django.shortcuts.render`` measuring the rendering of the template
+    """
+    with measure("template:%s" % template_name):
+        return shortcuts.render(request, template_name, context, **kwargs)
+
+
+def record(name, *, queries, db_time, wall_time):
+    with _lock:
+        totals = _totals.setdefault(name, [0, 0, 0.0, 0.0])
+        totals[0] += 1
+        totals[1] += queries
+        totals[2] += db_time
+        totals[3] += wall_time
+    operation_measured.send(
+        sender=None, name=name, queries=queries, db_time=db_time, wall_time=wall_time
+    )
+
+
+def reset():
+    with _lock:
+        _totals.clear()
+
+
+def prometheus_text():
+    """
+    Return the totals of the current process in the Prometheus text format
+    """
+    with _lock:
+        totals = sorted((name, list(values)) for name, values in _totals.items())
+    lines = []
+    for index, (metric, help) in enumerate(METRICS):
+        lines.append("# HELP %s %s" % (metric, help))
+        lines.append("# TYPE %s counter" % metric)
+        for name, values in totals:
+            name = name.replace("\\", "\\\\").replace('"', '\\"')
+            lines.append('%s{operation="%s"} %s' % (metric, name, values[index]))
+    return "\n".join(lines) + "\n"
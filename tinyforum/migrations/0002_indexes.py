@@ -0,0 +1,32 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("tinyforum", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="post",
+            index=models.Index(
+                condition=models.Q(("moderation_status", "hidden"), _negated=True),
+                fields=["thread", "created_at", "id"],
+                name="tinyforum_post_visible",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="thread",
+            index=models.Index(
+                condition=models.Q(
+                    ("closed_at__isnull", True),
+                    models.Q(("moderation_status", "hidden"), _negated=True),
+                ),
+                fields=["-is_pinned", "-created_at"],
+                name="tinyforum_thread_active",
+            ),
+        ),
+    ]
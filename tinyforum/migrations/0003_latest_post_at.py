@@ -0,0 +1,71 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:11
+
+import django.utils.timezone
+from django.contrib.auth import get_user_model
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def denormalize_latest_post(apps, schema_editor):
+    Thread = apps.get_model("tinyforum", "Thread")
+    Post = apps.get_model("tinyforum", "Post")
+    posts = Post.objects.filter(pk=OuterRef("latest_post"))
+    author = "authored_by__%s" % get_user_model().USERNAME_FIELD
+    Thread.objects.update(
+        latest_post_at=Coalesce(
+            Subquery(posts.values("created_at")[:1]), F("created_at")
+        ),
+        latest_post_author=Coalesce(Subquery(posts.values(author)[:1]), Value("")),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("tinyforum", "0002_indexes"),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name="thread",
+            options={
+                "ordering": ["-is_pinned", "-latest_post_at", "-created_at"],
+                "verbose_name": "thread",
+                "verbose_name_plural": "threads",
+            },
+        ),
+        migrations.RemoveIndex(
+            model_name="thread",
+            name="tinyforum_thread_active",
+        ),
+        migrations.AddField(
+            model_name="thread",
+            name="latest_post_at",
+            field=models.DateTimeField(
+                blank=True,
+                default=django.utils.timezone.now,
+                verbose_name="latest post at",
+            ),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name="thread",
+            name="latest_post_author",
+            field=models.CharField(
+                blank=True, max_length=254, verbose_name="latest post author"
+            ),
+        ),
+        migrations.RunPython(denormalize_latest_post, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name="thread",
+            index=models.Index(
+                condition=models.Q(
+                    ("closed_at__isnull", True),
+                    models.Q(("moderation_status", "hidden"), _negated=True),
+                ),
+                fields=["-is_pinned", "-latest_post_at", "-created_at", "-id"],
+                name="tinyforum_thread_active",
+            ),
+        ),
+    ]
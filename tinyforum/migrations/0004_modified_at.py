@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:15
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("tinyforum", "0003_latest_post_at"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="thread",
+            name="modified_at",
+            field=models.DateTimeField(
+                db_index=True,
+                default=django.utils.timezone.now,
+                verbose_name="modified at",
+            ),
+        ),
+    ]
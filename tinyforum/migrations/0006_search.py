@@ -0,0 +1,81 @@
+from itertools import islice
+
+from django.conf import settings
+from django.db import migrations
+from django.utils.html import strip_tags
+
+# The SQL is repeated here instead of using tinyforum.search so that later
+# changes to the module do not change what this migration does.
+TABLES = [
+    ("Post", "tinyforum_post_search", "tinyforum_post", "text", strip_tags),
+    ("Thread", "tinyforum_thread_search", "tinyforum_thread", "title", str),
+]
+CHUNK_SIZE = 1000
+
+
+def create_tables(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    for _model, table, foreign_table, _field, _clean in TABLES:
+        if vendor == "sqlite":
+            schema_editor.execute(
+                "CREATE VIRTUAL TABLE %s USING fts5(document)" % table
+            )
+        elif vendor == "postgresql":
+            schema_editor.execute(
+                "CREATE TABLE %s (id integer PRIMARY KEY REFERENCES %s (id)"
+                " ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED,"
+                " document tsvector NOT NULL)" % (table, foreign_table)
+            )
+            schema_editor.execute(
+                "CREATE INDEX %s_document ON %s USING gin (document)" % (table, table)
+            )
+
+
+def drop_tables(apps, schema_editor):
+    if schema_editor.connection.vendor in {"sqlite", "postgresql"}:
+        for _model, table, _foreign_table, _field, _clean in TABLES:
+            schema_editor.execute("DROP TABLE %s" % table)
+
+
+def index_all(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == "sqlite":
+        sql = "INSERT OR REPLACE INTO %s (rowid, document) VALUES (%%s, %%s)"
+        params = []
+    elif connection.vendor == "postgresql":
+        sql = (
+            "INSERT INTO %s (id, document)"
+            " VALUES (%%s, to_tsvector(%%s::regconfig, %%s))"
+            " ON CONFLICT (id) DO UPDATE SET document = EXCLUDED.document"
+        )
+        params = [getattr(settings, "TINYFORUM_SEARCH_CONFIG", "simple")]
+    else:
+        return
+
+    for model, table, _foreign_table, field, clean in TABLES:
+        rows = (
+            apps.get_model("tinyforum", model)
+            .objects.using(connection.alias)
+            .order_by()
+            .values_list("pk", field)
+            .iterator(chunk_size=CHUNK_SIZE)
+        )
+        with connection.cursor() as cursor:
+            while True:
+                chunk = list(islice(rows, CHUNK_SIZE))
+                if not chunk:
+                    break
+                cursor.executemany(
+                    sql % table,
+                    [[pk, *params, clean(document)] for pk, document in chunk],
+                )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("tinyforum", "0005_readmarker")]
+
+    operations = [
+        migrations.RunPython(create_tables, drop_tables),
+        migrations.RunPython(index_all, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("tinyforum", "0006_search"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="postreport",
+            index=models.Index(
+                condition=models.Q(("handled_at__isnull", True)),
+                fields=["post", "created_at"],
+                name="tinyforum_postreport_open",
+            ),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:24
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("tinyforum", "0007_postreport_open"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="postreport",
+            name="claimed_by",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="+",
+                to=settings.AUTH_USER_MODEL,
+                verbose_name="claimed by",
+            ),
+        ),
+        migrations.AddField(
+            model_name="postreport",
+            name="claimed_until",
+            field=models.DateTimeField(
+                blank=True, null=True, verbose_name="claimed until"
+            ),
+        ),
+    ]
@@ -0,0 +1,36 @@
+from django.db import migrations
+
+# PostgreSQL removes index rows of deleted posts and threads using foreign
+# keys, FTS5 tables cannot have foreign keys so SQLite uses triggers.
+TABLES = [
+    ("tinyforum_post_search", "tinyforum_post"),
+    ("tinyforum_thread_search", "tinyforum_thread"),
+]
+
+
+def create_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    for table, foreign_table in TABLES:
+        schema_editor.execute(
+            "DELETE FROM %s WHERE rowid NOT IN (SELECT id FROM %s)"
+            % (table, foreign_table)
+        )
+        schema_editor.execute(
+            "CREATE TRIGGER %s_delete AFTER DELETE ON %s"
+            " BEGIN DELETE FROM %s WHERE rowid = old.id; END"
+            % (table, foreign_table, table)
+        )
+
+
+def drop_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor == "sqlite":
+        for table, _foreign_table in TABLES:
+            schema_editor.execute("DROP TRIGGER %s_delete" % table)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("tinyforum", "0010_notification")]
+
+    operations = [migrations.RunPython(create_triggers, drop_triggers)]
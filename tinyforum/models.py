@@ -1,6 +1,15 @@
+import threading
+from contextlib import contextmanager
+from datetime import timedelta
+
 from ckeditor.fields import RichTextField
 from django.conf import settings
-from django.db import models
+from django.contrib.auth import get_user_model
+from django.db import connection, models, transaction
+from django.db.models import Count, F, Max, Min, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.urls import reverse
 from django.utils import timezone
 from django.utils.html import strip_tags
@@ -8,6 +17,22 @@ from django.utils.text import Truncator
 from django.utils.translation import gettext_lazy as _
 from html_sanitizer.django import get_sanitizer
 
+from tinyforum import live, outbox
+from tinyforum.cache import (
+    GENERATION_VERSION_KEY,
+    bump_thread_versions,
+    bump_versions,
+    get_read_marker,
+    set_read_marker,
+)
+from tinyforum.metrics import instrument, measure
+from tinyforum.search import index_posts, index_threads
+from tinyforum.signals import post_created
+
+# Threads recounted per query, stays below the number of query parameters
+# SQLite accepts
+RECOUNT_CHUNK_SIZE = 500
+
 
 class BaseQuerySet(models.QuerySet):
     def visible(self):
@@ -48,6 +73,52 @@ class BaseModel(models.Model):
         abstract = True
 
 
+def _latest_visible_post():
+    posts = (
+        Post.objects.visible()
+        .filter(thread=OuterRef("pk"))
+        .order_by("-created_at", "-id")
+    )
+    author = "authored_by__%s" % get_user_model().USERNAME_FIELD
+    return {
+        "latest_post": Subquery(posts.values("pk")[:1]),
+        "latest_post_at": Coalesce(
+            Subquery(posts.values("created_at")[:1]), F("created_at")
+        ),
+        "latest_post_author": Coalesce(Subquery(posts.values(author)[:1]), Value("")),
+    }
+
+
+def _counters():
+    posts = Post.objects.visible().filter(thread=OuterRef("pk")).order_by()
+    return {
+        "post_count": Coalesce(
+            Subquery(
+                posts.values("thread").annotate(count=Count("pk")).values("count")
+            ),
+            0,
+        ),
+        **_latest_visible_post(),
+    }
+
+
+def _available_reports(user, prefix=""):
+    # Conditions of PostReportQuerySet.available, prefix is used for lookups
+    # through relations
+    def q(**kwargs):
+        return Q(**{prefix + key: value for key, value in kwargs.items()})
+
+    return (
+        q(handled_at__isnull=True)
+        & ~q(authored_by=user)
+        & (
+            q(claimed_by__isnull=True)
+            | q(claimed_by=user)
+            | q(claimed_until__lt=timezone.now())
+        )
+    )
+
+
 class ThreadQuerySet(BaseQuerySet):
     def active(self):
         return self.visible().filter(closed_at__isnull=True)
@@ -55,6 +126,73 @@ class ThreadQuerySet(BaseQuerySet):
     def closed(self):
         return self.visible().filter(closed_at__isnull=False)
 
+    def with_unread_count(self, user):
+        """
+        Annotate the number of posts ``user`` has seen in each thread using
+        a subquery, see ``Thread.unread_count``
+        """
+        return self.annotate(
+            read_post_count=Coalesce(
+                Subquery(
+                    ReadMarker.objects.filter(user=user, thread=OuterRef("pk")).values(
+                        "post_count"
+                    )[:1]
+                ),
+                0,
+            )
+        )
+
+    @instrument("model:Thread.recount")
+    def recount(self, *, bump=True):
+        """
+        Recompute ``post_count`` and the latest post fields of all threads in
+        the queryset using a single ``UPDATE`` statement
+
+        Callers recounting in chunks pass ``bump=False`` and invalidate the
+        cached pages once at the end.
+        """
+        count = self.update(modified_at=timezone.now(), **_counters())
+        if bump:
+            bump_versions([GENERATION_VERSION_KEY])
+        return count
+
+    recount.alters_data = True
+
+    def with_expected_counters(self):
+        """
+        Annotate the values ``recount`` would set as ``expected_post_count``,
+        ``expected_latest_post`` etc.
+        """
+        return self.annotate(
+            **{"expected_%s" % name: value for name, value in _counters().items()}
+        )
+
+    def drifted(self, *, chunk_size=1000):
+        """
+        Check ``chunk_size`` threads per query in primary key order and yield
+        the number of checked threads and the drifted threads of each chunk
+
+        Drifted threads are dictionaries containing the primary key and the
+        current and the expected values of ``Thread.COUNTER_FIELDS``.
+        """
+        fields = Thread.COUNTER_FIELDS
+        queryset = (
+            self.with_expected_counters()
+            .order_by("pk")
+            .values("pk", *fields, *["expected_%s" % field for field in fields])
+        )
+        last = 0
+        while True:
+            rows = list(queryset.filter(pk__gt=last)[:chunk_size])
+            if not rows:
+                return
+            last = rows[-1]["pk"]
+            yield len(rows), [
+                row
+                for row in rows
+                if any(row[field] != row["expected_%s" % field] for field in fields)
+            ]
+
 
 class Thread(BaseModel):
     title = models.CharField(_("title"), max_length=200)
@@ -73,7 +211,18 @@ class Thread(BaseModel):
         null=True,
         verbose_name=_("latest post"),
     )
+    # Denormalized from latest_post so that the thread list neither has to
+    # join the post nor the user table
+    latest_post_at = models.DateTimeField(_("latest post at"), blank=True)
+    latest_post_author = models.CharField(
+        _("latest post author"), max_length=254, blank=True
+    )
     post_count = models.IntegerField(_("post count"), default=0)
+    # Updated whenever the thread or one of its posts changes, used for
+    # conditional GET requests
+    modified_at = models.DateTimeField(
+        _("modified at"), default=timezone.now, db_index=True
+    )
     starred_by = models.ManyToManyField(
         settings.AUTH_USER_MODEL,
         blank=True,
@@ -81,29 +230,117 @@ class Thread(BaseModel):
         verbose_name=_("starred by"),
     )
 
+    COUNTER_FIELDS = (
+        "post_count",
+        "latest_post",
+        "latest_post_at",
+        "latest_post_author",
+    )
+
     objects = ThreadQuerySet.as_manager()
 
     class Meta:
-        ordering = ["-is_pinned", "-latest_post__created_at", "-created_at"]
+        ordering = ["-is_pinned", "-latest_post_at", "-created_at"]
+        indexes = [
+            # Partial indexes are plain composite indexes on backends not
+            # supporting conditions.
+            models.Index(
+                fields=["-is_pinned", "-latest_post_at", "-created_at", "-id"],
+                name="tinyforum_thread_active",
+                condition=Q(closed_at__isnull=True) & ~Q(moderation_status="hidden"),
+            )
+        ]
         verbose_name = _("thread")
         verbose_name_plural = _("threads")
 
     def __str__(self):
         return self.title
 
+    @property
+    def unread_count(self):
+        if not hasattr(self, "read_post_count"):
+            return None
+        return max(0, self.post_count - self.read_post_count)
+
     def get_absolute_url(self):
         if self.moderation_status == self.HIDDEN:
             return reverse("tinyforum:thread-list")
         return reverse("tinyforum:thread-detail", kwargs={"pk": self.pk})
 
+    @instrument("model:Thread.save")
     def save(self, *args, **kwargs):
-        if self.pk:
-            self.post_count = self.posts.visible().count()
-            self.latest_post = self.posts.visible().last()
+        if self.latest_post_at is None:
+            self.latest_post_at = self.created_at
+        self.modified_at = timezone.now()
         super().save(*args, **kwargs)
+        index_threads([self])
+        bump_thread_versions(self.pk)
 
     save.alters_data = True
 
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, *args):
+        # The counters are maintained by Post.save using atomic updates, do not
+        # overwrite them with possibly stale values. Inserts (force_insert or
+        # a row which has been deleted in the meantime) still write them.
+        if update_fields is None:
+            values = [
+                value for value in values if value[0].name not in self.COUNTER_FIELDS
+            ]
+        return super()._do_update(base_qs, using, pk_val, values, update_fields, *args)
+
+
+class PostQuerySet(BaseQuerySet):
+    def moderate(self, moderation_status, *, bump=True):
+        """
+        Set the moderation status of all posts in the queryset using a single
+        ``UPDATE`` and recount the affected threads once
+
+        Returns the number of posts whose status changed. Callers passing
+        ``bump=False`` invalidate the cached pages themselves, see
+        ``ThreadQuerySet.recount``.
+        """
+        posts = self.exclude(moderation_status=moderation_status).order_by()
+        changed = list(posts.values_list("pk", "thread"))
+        count = posts.update(moderation_status=moderation_status)
+        threads = sorted({thread for pk, thread in changed})
+        for start in range(0, len(threads), RECOUNT_CHUNK_SIZE):
+            stop = start + RECOUNT_CHUNK_SIZE
+            Thread.objects.filter(pk__in=threads[start:stop]).recount(bump=False)
+        if threads and bump:
+            bump_versions([GENERATION_VERSION_KEY])
+        if moderation_status == Post.HIDDEN:
+            for pk, thread in changed:
+                live.publish(thread, {"type": "hide", "id": pk})
+        return count
+
+    moderate.alters_data = True
+
+    def reported(self, *, user=None):
+        """
+        Return posts with unhandled reports, aggregating the reports per post
+
+        Posts are annotated with ``report_count``, ``first_reported_at``,
+        ``last_reported_at`` and ``report_count_<reason>`` for each reason.
+        If ``user`` is given only the reports available to the user are
+        considered, see ``PostReportQuerySet.available``. The posts are found
+        using the ``tinyforum_postreport_open`` index.
+        """
+        reports = Q(reports__handled_at__isnull=True)
+        open_reports = PostReport.objects.filter(handled_at__isnull=True)
+        if user is not None:
+            reports = _available_reports(user, "reports__")
+            open_reports = open_reports.available(user)
+        return self.filter(pk__in=open_reports.values("post")).annotate(
+            report_count=Count("reports", filter=reports),
+            first_reported_at=Min("reports__created_at", filter=reports),
+            last_reported_at=Max("reports__created_at", filter=reports),
+            **{
+                "report_count_%s"
+                % reason: Count("reports", filter=reports & Q(reports__reason=reason))
+                for reason, _label in Report.REASON_CHOICES
+            }
+        )
+
 
 class Post(BaseModel):
     thread = models.ForeignKey(
@@ -111,21 +348,81 @@ class Post(BaseModel):
     )
     text = RichTextField(_("text"), config_name="tinyforum-post")
 
+    objects = PostQuerySet.as_manager()
+
     class Meta:
         ordering = ["created_at"]
+        indexes = [
+            models.Index(
+                fields=["thread", "created_at", "id"],
+                name="tinyforum_post_visible",
+                condition=~Q(moderation_status="hidden"),
+            )
+        ]
         verbose_name = _("post")
         verbose_name_plural = _("post")
 
     def __str__(self):
         return Truncator(strip_tags(self.text)).words(20, truncate="...")
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_moderation_status = instance.__dict__.get("moderation_status")
+        return instance
+
+    @instrument("model:Post.save")
     def save(self, *args, **kwargs):
-        self.text = get_sanitizer("tinyforum-post").sanitize(self.text)
+        with measure("model:Post.sanitize"):
+            self.text = get_sanitizer("tinyforum-post").sanitize(self.text)
+        if self._state.adding and self.pk is None:
+            was_visible = False
+        elif getattr(self, "_loaded_moderation_status", None) is None:
+            was_visible = None
+        else:
+            was_visible = self._loaded_moderation_status != self.HIDDEN
         super().save(*args, **kwargs)
-        self.thread.save()
+        index_posts([self])
+        self.update_thread(was_visible=was_visible)
+        live.publish_post(self, was_visible=was_visible)
+        self._loaded_moderation_status = self.moderation_status
 
     save.alters_data = True
 
+    @instrument("model:Post.update_thread")
+    def update_thread(self, *, was_visible=None):
+        """
+        Update the thread's ``post_count`` and latest post fields after this
+        post has been saved
+
+        ``was_visible`` is the visibility of the post before saving it. A
+        value of ``None`` means unknown and recounts the thread.
+        """
+        threads = Thread.objects.filter(pk=self.thread_id)
+        is_visible = self.moderation_status != self.HIDDEN
+        now = timezone.now()
+        if was_visible is None:
+            threads.recount()
+        elif is_visible and not was_visible:
+            threads.update(post_count=F("post_count") + 1, modified_at=now)
+            threads.filter(
+                Q(latest_post__isnull=True)
+                | Q(latest_post__created_at__lt=self.created_at)
+                | Q(latest_post__created_at=self.created_at, latest_post__lt=self.pk)
+            ).update(
+                latest_post=self,
+                latest_post_at=self.created_at,
+                latest_post_author=self.authored_by.get_username(),
+            )
+        elif was_visible and not is_visible:
+            threads.update(post_count=F("post_count") - 1, modified_at=now)
+            threads.filter(latest_post=self).update(**_latest_visible_post())
+        else:
+            threads.update(modified_at=now)
+        bump_thread_versions(self.thread_id)
+
+    update_thread.alters_data = True
+
 
 class Report(BaseModel):
     REASON_CHOICES = (
@@ -139,6 +436,16 @@ class Report(BaseModel):
         _("notes"), blank=True, help_text=_("Anything else you want to say?")
     )
 
+    claimed_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.SET_NULL,
+        blank=True,
+        null=True,
+        verbose_name=_("claimed by"),
+        related_name="+",
+    )
+    claimed_until = models.DateTimeField(_("claimed until"), blank=True, null=True)
+
     handled_at = models.DateTimeField(_("handled at"), blank=True, null=True)
     handled_by = models.ForeignKey(
         settings.AUTH_USER_MODEL,
@@ -161,12 +468,312 @@ class Report(BaseModel):
         abstract = True
 
 
+class PostReportQuerySet(BaseQuerySet):
+    def available(self, user):
+        """
+        Return unhandled reports which ``user`` may work on, that is reports
+        by other users which are not claimed by another moderator
+        """
+        return self.filter(_available_reports(user))
+
+    def claimed(self, user):
+        """
+        Return unhandled reports whose claim by ``user`` has not expired yet
+        """
+        return self.filter(
+            handled_at__isnull=True, claimed_by=user, claimed_until__gte=timezone.now()
+        )
+
+    def claim(self, user, *, count=20):
+        """
+        Claim up to ``count`` available reports for ``user`` and return them
+
+        Claims expire after ``TINYFORUM_CLAIM_TIMEOUT`` seconds (defaults to
+        600). Rows are locked using ``SELECT ... FOR UPDATE SKIP LOCKED`` if
+        the database supports it, so that concurrent moderators neither wait
+        for each other nor receive the same reports. Elsewhere (e.g. SQLite,
+        which serializes writes anyway) the conditional ``UPDATE`` alone
+        prevents claiming a report twice.
+        """
+        claimed_until = timezone.now() + timedelta(
+            seconds=getattr(settings, "TINYFORUM_CLAIM_TIMEOUT", 600)
+        )
+        with transaction.atomic():
+            available = self.available(user).order_by("created_at", "id")
+            candidates = available
+            features = connection.features
+            if features.has_select_for_update_skip_locked:  # pragma: no cover
+                candidates = candidates.select_for_update(skip_locked=True)
+            ids = list(candidates.values_list("pk", flat=True)[:count])
+            available.filter(pk__in=ids).update(
+                claimed_by=user, claimed_until=claimed_until
+            )
+        return list(
+            PostReport.objects.filter(
+                pk__in=ids, claimed_by=user, claimed_until=claimed_until
+            )
+            .select_related("post__authored_by", "post__thread", "authored_by")
+            .order_by("created_at", "id")
+        )
+
+    claim.alters_data = True
+
+    def release(self, user):
+        """
+        Return the reports claimed by ``user`` to the queue
+        """
+        return self.filter(claimed_by=user).update(claimed_by=None, claimed_until=None)
+
+    release.alters_data = True
+
+    @outbox.atomic
+    def handle(self, moderation_status, *, handled_by, request=None):
+        """
+        Handle all unhandled reports in the queryset at once and apply
+        ``moderation_status`` to their posts
+
+        Sends ``post_report_handled`` for each handled report and
+        ``post_reports_handled`` once with the list of handled reports.
+        """
+        reports = list(self.filter(handled_at__isnull=True))
+        if not reports:
+            return reports
+        now = timezone.now()
+        PostReport.objects.filter(pk__in=[report.pk for report in reports]).update(
+            moderation_status=moderation_status, handled_at=now, handled_by=handled_by
+        )
+        Post.objects.filter(pk__in={report.post_id for report in reports}).moderate(
+            moderation_status
+        )
+        for report in reports:
+            report.moderation_status = moderation_status
+            report.handled_at = now
+            report.handled_by = handled_by
+        outbox.send_each("post_report_handled", reports, form=None, request=request)
+        outbox.send("post_reports_handled", instances=reports, request=request)
+        return reports
+
+    handle.alters_data = True
+
+
 class PostReport(Report):
     post = models.ForeignKey(
         Post, on_delete=models.CASCADE, related_name="reports", verbose_name=_("post")
     )
 
+    objects = PostReportQuerySet.as_manager()
+
     class Meta:
+        indexes = [
+            models.Index(
+                fields=["post", "created_at"],
+                name="tinyforum_postreport_open",
+                condition=Q(handled_at__isnull=True),
+            )
+        ]
         unique_together = (("authored_by", "post"),)
         verbose_name = _("post report")
         verbose_name_plural = _("post reports")
+
+
+class ReadMarkerQuerySet(models.QuerySet):
+    def mark_read(self, user, thread, post_count):
+        """
+        Remember that ``user`` has seen the first ``post_count`` posts of
+        ``thread``
+
+        Writes are skipped if the cache says that the user has already seen
+        at least as many posts, and markers never move backwards.
+        """
+        if (get_read_marker(user, thread.pk) or 0) >= post_count:
+            return
+        if not self.filter(user=user, thread=thread, post_count__lt=post_count).update(
+            post_count=post_count, updated_at=timezone.now()
+        ):
+            self.get_or_create(
+                user=user, thread=thread, defaults={"post_count": post_count}
+            )
+        set_read_marker(user, thread.pk, post_count)
+
+    mark_read.alters_data = True
+
+
+class ReadMarker(models.Model):
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name="+",
+        verbose_name=_("user"),
+    )
+    thread = models.ForeignKey(
+        Thread,
+        on_delete=models.CASCADE,
+        related_name="read_markers",
+        verbose_name=_("thread"),
+    )
+    post_count = models.IntegerField(_("post count"), default=0)
+    updated_at = models.DateTimeField(_("updated at"), default=timezone.now)
+
+    objects = ReadMarkerQuerySet.as_manager()
+
+    class Meta:
+        unique_together = (("user", "thread"),)
+        verbose_name = _("read marker")
+        verbose_name_plural = _("read markers")
+
+    def __str__(self):
+        return "%s: %s" % (self.thread_id, self.post_count)
+
+
+class OutboxEvent(models.Model):
+    signal = models.CharField(_("signal"), max_length=50)
+    object_ids = models.TextField(_("object IDs"))
+    created_at = models.DateTimeField(_("created at"), default=timezone.now)
+    available_at = models.DateTimeField(
+        _("available at"), default=timezone.now, db_index=True
+    )
+    attempts = models.IntegerField(_("attempts"), default=0)
+    last_error = models.TextField(_("last error"), blank=True)
+
+    class Meta:
+        ordering = ["available_at"]
+        verbose_name = _("outbox event")
+        verbose_name_plural = _("outbox events")
+
+    def __str__(self):
+        return "%s: %s" % (self.signal, self.object_ids)
+
+
+class NotificationQuerySet(models.QuerySet):
+    def pending(self):
+        return self.filter(sent_at__isnull=True)
+
+    def notify(self, post, *, chunk_size=1000):
+        """
+        Notify the users who starred the thread of ``post`` except its author
+
+        Pending notifications are coalesced into a digest by incrementing
+        their ``post_count`` using a single ``UPDATE``. Users without a
+        pending notification get a new one, inserted in chunks of
+        ``chunk_size`` rows.
+        """
+        now = timezone.now()
+        pending = self.pending().filter(thread=post.thread_id)
+        pending.exclude(user=post.authored_by_id).update(
+            post_count=F("post_count") + 1, updated_at=now
+        )
+        user_ids = (
+            Thread.starred_by.through.objects.filter(thread=post.thread_id)
+            .exclude(user=post.authored_by_id)
+            .exclude(user__in=pending.values("user"))
+            .values_list("user", flat=True)
+            .order_by()
+        )
+        notifications = [
+            Notification(
+                user_id=user_id,
+                thread_id=post.thread_id,
+                first_post=post,
+                created_at=now,
+                updated_at=now,
+            )
+            for user_id in user_ids
+        ]
+        self.bulk_create(notifications, batch_size=chunk_size, ignore_conflicts=True)
+        return len(notifications)
+
+    notify.alters_data = True
+
+    def mark_sent(self):
+        return self.pending().update(sent_at=timezone.now())
+
+    mark_sent.alters_data = True
+
+
+class Notification(models.Model):
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name="+",
+        verbose_name=_("user"),
+    )
+    thread = models.ForeignKey(
+        Thread,
+        on_delete=models.CASCADE,
+        related_name="notifications",
+        verbose_name=_("thread"),
+    )
+    first_post = models.ForeignKey(
+        Post, on_delete=models.CASCADE, related_name="+", verbose_name=_("first post")
+    )
+    post_count = models.IntegerField(_("post count"), default=1)
+    created_at = models.DateTimeField(_("created at"), default=timezone.now)
+    updated_at = models.DateTimeField(_("updated at"), default=timezone.now)
+    sent_at = models.DateTimeField(_("sent at"), blank=True, null=True)
+
+    objects = NotificationQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            # At most one pending digest per user and thread
+            models.UniqueConstraint(
+                fields=["user", "thread"],
+                condition=Q(sent_at__isnull=True),
+                name="tinyforum_notification_pending",
+            )
+        ]
+        ordering = ["-updated_at"]
+        verbose_name = _("notification")
+        verbose_name_plural = _("notifications")
+
+    def __str__(self):
+        return "%s: %s" % (self.thread_id, self.post_count)
+
+
+_deletions = threading.local()
+
+
+@contextmanager
+def bulk_deletions():
+    """
+    Skip the per-row thread updates of the delete receivers below, the
+    caller has to recount the affected threads and bump the versions
+    """
+    _deletions.bulk = True
+    try:
+        yield
+    finally:
+        _deletions.bulk = False
+
+
+@receiver(post_delete, sender=Post)
+def update_thread_after_post_delete(sender, instance, **kwargs):
+    # Also sent for deletions in the admin and through a CASCADE. The latest
+    # post has already been set to NULL if it was this post.
+    if getattr(_deletions, "bulk", False):
+        return
+    threads = Thread.objects.filter(pk=instance.thread_id)
+    now = timezone.now()
+    if instance.moderation_status == Post.HIDDEN:
+        threads.update(modified_at=now)
+    else:
+        threads.update(post_count=F("post_count") - 1, modified_at=now)
+        threads.filter(latest_post__isnull=True).update(**_latest_visible_post())
+    bump_thread_versions(instance.thread_id)
+
+
+@receiver(post_delete, sender=Thread)
+def update_thread_list_after_thread_delete(sender, instance, **kwargs):
+    # The validators of the thread list use the latest modification of the
+    # remaining threads, move it forward
+    if getattr(_deletions, "bulk", False):
+        return
+    latest = Thread.objects.order_by("-modified_at").values_list("pk", flat=True)
+    Thread.objects.filter(pk__in=list(latest[:1])).update(modified_at=timezone.now())
+    bump_thread_versions(instance.pk)
+
+
+@receiver(post_created)
+def notify_subscribers(sender, instance, **kwargs):
+    if getattr(settings, "TINYFORUM_NOTIFICATIONS", False):
+        Notification.objects.notify(instance)
@@ -0,0 +1,179 @@
+"""
+Optional outbox for the signals in ``tinyforum.signals``
+
+Signals are sent synchronously by default. With ``TINYFORUM_OUTBOX = True``
+an ``OutboxEvent`` is written in the transaction of the change instead and
+the ``tinyforum_outbox`` management command sends the signals later using a
+thread pool. Receivers get ``form=None`` and ``request=None`` then.
+"""
+
+import json
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from functools import wraps
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from tinyforum import signals
+
+# Signal name: (sender model, argument containing the instance(s))
+SIGNALS = {
+    "post_created": ("Post", "instance"),
+    "post_report_handled": ("PostReport", "instance"),
+    "post_reports_handled": ("PostReport", "instances"),
+}
+
+
+def outbox_enabled():
+    return getattr(settings, "TINYFORUM_OUTBOX", False)
+
+
+def atomic(func):
+    """
+    Run ``func`` in a transaction if the outbox is enabled
+
+    Events are stored together with the change then. Without the outbox the
+    signals are sent synchronously and receivers should not run inside a
+    transaction they do not know about.
+    """
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not outbox_enabled():
+            return func(*args, **kwargs)
+        with transaction.atomic():
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def send(name, **kwargs):
+    """
+    Send the signal ``name`` or add it to the outbox if enabled
+    """
+    model_name, argument = SIGNALS[name]
+    if not outbox_enabled():
+        getattr(signals, name).send(
+            sender=apps.get_model("tinyforum", model_name), **kwargs
+        )
+        return
+
+    value = kwargs[argument]
+    apps.get_model("tinyforum", "OutboxEvent").objects.create(
+        signal=name,
+        object_ids=json.dumps(
+            [obj.pk for obj in value] if argument == "instances" else [value.pk]
+        ),
+    )
+
+
+def send_each(name, instances, **kwargs):
+    """
+    Send the signal ``name`` once for each of ``instances`` or add all of them
+    to the outbox using a single query if enabled
+    """
+    model_name, argument = SIGNALS[name]
+    if not outbox_enabled():
+        for instance in instances:
+            send(name, **{argument: instance}, **kwargs)
+        return
+
+    OutboxEvent = apps.get_model("tinyforum", "OutboxEvent")
+    OutboxEvent.objects.bulk_create(
+        [OutboxEvent(signal=name, object_ids=json.dumps([obj.pk])) for obj in instances]
+    )
+
+
+def deliver(events, *, workers=4):
+    """
+    Send the signals of ``events`` using a thread pool
+
+    Instances are loaded using one query per model in the calling thread.
+    Returns a list of ``(event, exception)`` tuples for failed events.
+    """
+    object_ids = defaultdict(set)
+    for event in events:
+        object_ids[SIGNALS[event.signal][0]].update(json.loads(event.object_ids))
+    objects = {
+        model_name: apps.get_model("tinyforum", model_name).objects.in_bulk(ids)
+        for model_name, ids in object_ids.items()
+    }
+
+    def send_event(event):
+        model_name, argument = SIGNALS[event.signal]
+        instances = [
+            objects[model_name][pk]
+            for pk in json.loads(event.object_ids)
+            if pk in objects[model_name]
+        ]
+        if not instances:
+            # Deleted in the meantime
+            return None
+        try:
+            getattr(signals, event.signal).send(
+                sender=apps.get_model("tinyforum", model_name),
+                form=None,
+                request=None,
+                **{argument: instances if argument == "instances" else instances[0]}
+            )
+        except Exception as exc:
+            return exc
+        finally:
+            # Each thread of the pool opens its own connection
+            connection.close()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(send_event, events)
+    return [(event, exc) for event, exc in zip(events, results) if exc is not None]
+
+
+def process(*, batch_size=100, workers=4, max_attempts=5):
+    """
+    Deliver a batch of due outbox events and return the number of delivered
+    and failed events
+
+    Events are claimed in a short transaction by moving them
+    ``TINYFORUM_OUTBOX_TIMEOUT`` seconds (defaults to 300) into the future
+    and delivered outside of it, so that slow receivers do not hold locks.
+    Events of a crashed process are delivered again after the timeout.
+    Delivered events are deleted. Failed events are retried with an
+    exponential backoff until ``max_attempts`` is reached.
+    """
+    OutboxEvent = apps.get_model("tinyforum", "OutboxEvent")
+    now = timezone.now()
+    claimed_until = now + timedelta(
+        seconds=getattr(settings, "TINYFORUM_OUTBOX_TIMEOUT", 300)
+    )
+    with transaction.atomic():
+        due = OutboxEvent.objects.filter(
+            available_at__lte=now, attempts__lt=max_attempts
+        )
+        candidates = due.order_by("available_at", "id")
+        features = connection.features
+        if features.has_select_for_update_skip_locked:  # pragma: no cover
+            candidates = candidates.select_for_update(skip_locked=True)
+        ids = list(candidates.values_list("pk", flat=True)[:batch_size])
+        due.filter(pk__in=ids).update(available_at=claimed_until)
+    events = list(
+        OutboxEvent.objects.filter(pk__in=ids, available_at=claimed_until).order_by(
+            "id"
+        )
+    )
+
+    failed = deliver(events, workers=workers)
+    failed_ids = {event.pk for event, exc in failed}
+    OutboxEvent.objects.filter(
+        pk__in=[event.pk for event in events if event.pk not in failed_ids]
+    ).delete()
+    for event, exc in failed:
+        OutboxEvent.objects.filter(pk=event.pk).update(
+            attempts=F("attempts") + 1,
+            available_at=now + timedelta(seconds=2**event.attempts * 10),
+            last_error=repr(exc),
+        )
+    return len(events) - len(failed), len(failed)
@@ -0,0 +1,95 @@
+"""
+Removal of all content of spammers
+
+Posts, threads and reports of the given users are hidden or deleted using
+a few statements per model instead of one per row. Counters are repaired
+afterwards, only for threads the users posted in, and no signals apart
+from Django's deletion signals are sent. The receivers of those skip their
+per-row thread updates.
+"""
+
+from django.db import transaction
+from django.utils import timezone
+
+from tinyforum.cache import GENERATION_VERSION_KEY, bump_versions
+from tinyforum.models import (
+    RECOUNT_CHUNK_SIZE,
+    Post,
+    PostReport,
+    Thread,
+    bulk_deletions,
+)
+
+
+@transaction.atomic
+def purge(users, *, delete=False, handled_by=None):
+    """
+    Hide or delete all threads, posts and reports authored by ``users``
+
+    Open reports on the hidden posts are handled by ``handled_by``, open
+    reports by ``users`` are dismissed. Returns a dictionary containing the
+    number of ``threads``, ``posts`` and ``reports`` and of ``recounted``
+    threads.
+    """
+    threads = Thread.objects.filter(authored_by__in=users)
+    posts = Post.objects.filter(authored_by__in=users)
+    reports = PostReport.objects.filter(authored_by__in=users)
+    if delete:
+        return _delete(threads, posts, reports)
+
+    now = timezone.now()
+    open_reports = PostReport.objects.filter(handled_at__isnull=True)
+    counts = {
+        "reports": open_reports.filter(post__in=posts).update(
+            moderation_status=PostReport.HIDDEN, handled_at=now, handled_by=handled_by
+        )
+        + reports.filter(handled_at__isnull=True).update(
+            handled_at=now, handled_by=handled_by
+        ),
+        "threads": threads.exclude(moderation_status=Thread.HIDDEN).update(
+            moderation_status=Thread.HIDDEN, modified_at=now
+        ),
+    }
+    # moderate recounts the threads of all changed posts in chunks
+    affected = set(
+        posts.exclude(moderation_status=Post.HIDDEN)
+        .order_by()
+        .values_list("thread", flat=True)
+        .distinct()
+    )
+    counts["posts"] = posts.moderate(Post.HIDDEN, bump=False)
+    counts["recounted"] = len(affected)
+    bump_versions([GENERATION_VERSION_KEY])
+    return counts
+
+
+def _delete(threads, posts, reports):
+    # Threads of the users disappear with all their posts, only the other
+    # threads the users posted in need new counters
+    affected = sorted(
+        set(
+            posts.exclude(thread__in=threads)
+            .order_by()
+            .values_list("thread", flat=True)
+            .distinct()
+        )
+    )
+    counts = {"threads": 0, "posts": 0, "reports": 0}
+    with bulk_deletions():
+        for queryset in [reports, threads, posts]:
+            _, deleted = queryset.delete()
+            for key, model in [
+                ("threads", Thread),
+                ("posts", Post),
+                ("reports", PostReport),
+            ]:
+                counts[key] += deleted.get(model._meta.label, 0)
+
+    counts["recounted"] = 0
+    for start in range(0, len(affected), RECOUNT_CHUNK_SIZE):
+        stop = start + RECOUNT_CHUNK_SIZE
+        counts["recounted"] += Thread.objects.filter(
+            pk__in=affected[start:stop]
+        ).recount(bump=False)
+    bump_versions([GENERATION_VERSION_KEY])
+    return counts
@@ -0,0 +1,103 @@
+"""
+Full text index for posts and thread titles
+
+Uses a ``tsvector`` column with a GIN index on PostgreSQL and FTS5 on
+SQLite. The index tables are not Django models, they are created by a
+migration and maintained by ``Post.save`` and ``Thread.save``. Other
+databases fall back to ``icontains`` lookups.
+
+All posts and threads are indexed, visibility is checked when searching
+so that the admin can find hidden content too. Rows of deleted posts and
+threads are removed by a foreign key on PostgreSQL and by a trigger on
+SQLite.
+"""
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from django.utils.html import strip_tags
+
+POST_TABLE = "tinyforum_post_search"
+THREAD_TABLE = "tinyforum_thread_search"
+
+
+class SQLiteBackend:
+    def index(self, cursor, table, rows):
+        cursor.executemany(
+            "INSERT OR REPLACE INTO %s (rowid, document) VALUES (%%s, %%s)" % table,
+            rows,
+        )
+
+    def match(self, table, query):
+        # Quote all terms, FTS5 query syntax is not meant for end users
+        terms = " ".join('"%s"' % term.replace('"', '""') for term in query.split())
+        return "SELECT rowid FROM %s WHERE %s MATCH %%s" % (table, table), [terms]
+
+
+class PostgreSQLBackend:
+    def index(self, cursor, table, rows):
+        cursor.executemany(
+            "INSERT INTO %s (id, document)"
+            " VALUES (%%s, to_tsvector(%%s::regconfig, %%s))"
+            " ON CONFLICT (id) DO UPDATE SET document = EXCLUDED.document" % table,
+            [(pk, _config(), document) for pk, document in rows],
+        )
+
+    def match(self, table, query):
+        return (
+            "SELECT id FROM %s WHERE document @@ plainto_tsquery(%%s::regconfig, %%s)"
+            % table,
+            [_config(), query],
+        )
+
+
+def _config():
+    return getattr(settings, "TINYFORUM_SEARCH_CONFIG", "simple")
+
+
+def get_backend():
+    if connection.vendor == "postgresql":
+        return PostgreSQLBackend()
+    elif connection.vendor == "sqlite":
+        return SQLiteBackend()
+    return None
+
+
+def _index(table, rows):
+    backend = get_backend()
+    if backend is not None and rows:
+        with connection.cursor() as cursor:
+            backend.index(cursor, table, rows)
+
+
+def index_posts(posts):
+    _index(POST_TABLE, [(post.pk, strip_tags(post.text)) for post in posts])
+
+
+def index_threads(threads):
+    _index(THREAD_TABLE, [(thread.pk, thread.title) for thread in threads])
+
+
+def _matches(table, query, fallback):
+    if not query.strip():
+        return Q(pk__in=[])
+    backend = get_backend()
+    if backend is None:
+        return Q(**{"%s__icontains" % fallback: query})
+    return Q(pk__in=RawSQL(*backend.match(table, query)))
+
+
+def post_matches(query):
+    """
+    Return a ``Q`` object matching posts containing all words of ``query``
+    """
+    return _matches(POST_TABLE, query, "text")
+
+
+def thread_matches(query):
+    """
+    Return a ``Q`` object matching threads whose title contains all words of
+    ``query``
+    """
+    return _matches(THREAD_TABLE, query, "title")
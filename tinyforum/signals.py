@@ -3,3 +3,5 @@ from django.dispatch import Signal
 
 post_created = Signal(providing_args=["instance", "form", "request"])
 post_report_handled = Signal(providing_args=["instance", "form", "request"])
+post_reports_handled = Signal(providing_args=["instances", "request"])
+operation_measured = Signal(providing_args=["name", "queries", "db_time", "wall_time"])
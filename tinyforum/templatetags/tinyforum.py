@@ -1,29 +1,56 @@
 from urllib.parse import urlencode
 
 from django import template
-from django.template.loader import render_to_string
+from django.template import Context
+from django.template.loader import get_template
 
+from tinyforum.cache import starred_thread_ids
+from tinyforum.models import Thread
 
 register = template.Library()
 
 
+def _render_star(context, thread, status):
+    # The template is looked up and a context is created once per page, rows
+    # only push their thread and status
+    star = context.render_context.get("tinyforum_star")
+    if star is None:
+        star = context.render_context["tinyforum_star"] = (
+            get_template("tinyforum/thread_star.html").template,
+            Context(autoescape=context.autoescape, use_l10n=context.use_l10n),
+        )
+    template, star_context = star
+    with star_context.push(thread=thread, status=status):
+        return template.render(star_context)
+
+
 @register.simple_tag(takes_context=True)
 def thread_star(context, thread):
     user = context["request"].user
     if not user.is_authenticated:
         return ""
 
-    if not hasattr(user, "starred_threads_cache"):
-        user.starred_threads_cache = list(
-            user.starred_threads.values_list("id", flat=True)
-        )
-    return render_to_string(
-        "tinyforum/thread_star.html",
-        {"thread": thread, "status": thread.id in user.starred_threads_cache},
-    )
+    # Look up the status of all threads in the current page at once
+    status = context.render_context.setdefault("tinyforum_starred", {})
+    if thread.id not in status:
+        ids = {
+            obj.id for obj in context.get("object_list", ()) if isinstance(obj, Thread)
+        }
+        ids.add(thread.id)
+        starred = starred_thread_ids(user, ids)
+        status.update((id, id in starred) for id in ids)
+
+    return _render_star(context, thread, status[thread.id])
 
 
 @register.simple_tag(takes_context=True)
 def pagination_link(context, **kwargs):
-    query = urlencode(sorted(dict(context["request"].GET.items(), **kwargs).items()))
+    # Keyset cursors are only valid for the page they have been generated for
+    params = {
+        key: value
+        for key, value in context["request"].GET.items()
+        if key not in {"after", "before"}
+    }
+    params.update(kwargs)
+    query = urlencode(sorted((key, value) for key, value in params.items() if value))
     return "?%s" % query if query else "."
@@ -1,11 +1,18 @@
 # Copied from feincms3/shortcuts.py
 
-from django.core.paginator import Paginator
-from django.shortcuts import render
+from functools import reduce
+
+from django.core.exceptions import ValidationError
+from django.core.paginator import EmptyPage, Page, PageNotAnInteger, Paginator
+from django.db.models import Q
+
+from tinyforum.metrics import render
 
 
 __all__ = ("template_name", "render_list", "render_detail")
 
+CURSOR_SEPARATOR = "~"
+
 
 def template_name(model, template_name_suffix):
     return "%s/%s%s.html" % (
@@ -15,12 +22,119 @@ def template_name(model, template_name_suffix):
     )
 
 
-def paginate_list(request, iterable, paginate_by=None, orphans=0):
+def _key_field(model, key):
+    *path, name = key.lstrip("-").split("__")
+    for part in path:
+        model = model._meta.get_field(part).related_model
+    return model._meta.get_field(name)
+
+
+class KeysetPage(Page):
+    @property
+    def previous_cursor(self):
+        return self.paginator.cursor(self.object_list[0]) if self.object_list else ""
+
+    @property
+    def next_cursor(self):
+        return self.paginator.cursor(self.object_list[-1]) if self.object_list else ""
+
+
+class KeysetPaginator(Paginator):
+    """
+    Paginator which seeks using the ``keys`` ordering instead of scanning
+    through the table using ``OFFSET`` where possible
+
+    The first and the last page are always fetched directly, the
+    neighbours of a page are reached using the ``after`` and ``before``
+    cursors of ``KeysetPage``. Other pages and invalid cursors fall back to
+    ``OFFSET`` pagination. ``keys`` should end with a unique field and must
+    not contain nullable fields. Pass ``count`` if the total is known
+    already, e.g. because it is denormalized somewhere.
+    """
+
+    def __init__(self, object_list, per_page, orphans=0, *, keys, count=None):
+        super().__init__(object_list.order_by(*keys), per_page, orphans=orphans)
+        self.keys = keys
+        if count is not None:
+            self.count = count
+
+    def cursor(self, object):
+        values = []
+        for key in self.keys:
+            *path, name = key.lstrip("-").split("__")
+            owner = reduce(getattr, path, object)
+            if owner is None or getattr(owner, name) is None:
+                return ""
+            values.append(_key_field(type(object), key).value_to_string(owner))
+        return CURSOR_SEPARATOR.join(values)
+
+    def _seek(self, cursor, *, reverse):
+        values = cursor.split(CURSOR_SEPARATOR)
+        if len(values) != len(self.keys):
+            raise ValidationError("Invalid cursor")
+
+        model = self.object_list.model
+        q, equal = Q(), {}
+        for key, value in zip(self.keys, values):
+            name = key.lstrip("-")
+            value = _key_field(model, key).to_python(value)
+            lookup = "lt" if key.startswith("-") != reverse else "gt"
+            q |= Q(**equal, **{"%s__%s" % (name, lookup): value})
+            equal[name] = value
+        return self.object_list.filter(q)
+
+    def _reversed(self, queryset):
+        return queryset.order_by(
+            *(key[1:] if key.startswith("-") else "-" + key for key in self.keys)
+        )
+
+    def get_page(self, number, *, after=None, before=None):
+        try:
+            number = self.validate_number(number)
+        except PageNotAnInteger:
+            number = 1
+        except EmptyPage:
+            number = self.num_pages
+
+        try:
+            if number == self.num_pages:
+                size = self.count - (number - 1) * self.per_page
+                object_list = list(self._reversed(self.object_list)[:size])[::-1]
+            elif number == 1:
+                object_list = self.object_list[: self.per_page]
+            elif after:
+                object_list = self._seek(after, reverse=False)[: self.per_page]
+            elif before:
+                object_list = self._seek(before, reverse=True)
+                object_list = list(self._reversed(object_list)[: self.per_page])[::-1]
+            else:
+                return self.page(number)
+        except ValidationError:
+            return self.page(number)
+        return self._get_page(list(object_list), number, self)
+
+    def _get_page(self, *args, **kwargs):
+        return KeysetPage(*args, **kwargs)
+
+
+def paginate_list(
+    request, iterable, paginate_by=None, orphans=0, *, keys=None, count=None
+):
     if not paginate_by:
         return iterable
 
-    p = Paginator(iterable, paginate_by, orphans=orphans)
     page = request.GET.get("page")
+    if keys:
+        p = KeysetPaginator(
+            iterable, paginate_by, orphans=orphans, keys=keys, count=count
+        )
+        return p.get_page(
+            p.num_pages if page == "last" else page,
+            after=request.GET.get("after"),
+            before=request.GET.get("before"),
+        )
+
+    p = Paginator(iterable, paginate_by, orphans=orphans)
     return p.get_page(p.num_pages if page == "last" else page)
 
 
@@ -31,11 +145,18 @@ def render_list(
     *,
     template_name_suffix="_list",
     paginate_by=None,
-    orphans=0
+    orphans=0,
+    keys=None,
+    count=None
 ):
     context = context or {}
     object_list = paginate_list(
-        request, queryset, paginate_by=paginate_by, orphans=orphans
+        request,
+        queryset,
+        paginate_by=paginate_by,
+        orphans=orphans,
+        keys=keys,
+        count=count,
     )
     context.update(
         {
@@ -1,29 +1,87 @@
+import math
+import time
+
+from django.conf import settings
 from django.contrib import messages
-from django.http import JsonResponse
-from django.shortcuts import get_object_or_404, redirect, render
+from django.core.exceptions import PermissionDenied
+from django.db.models import Max
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404, redirect
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare
+from django.utils.dateparse import parse_datetime
 from django.utils.translation import gettext as _
+from django.views.decorators.http import condition, require_POST
 
+from tinyforum.cache import (
+    THREAD_LIST_VERSION_KEY,
+    cache_anonymous_page,
+    set_thread_starred,
+    thread_version_key,
+)
+from tinyforum.export import export_records, jsonl, zipped
 from tinyforum.forms import (
+    BulkHandlePostReportForm,
     CreatePostReportForm,
     HandlePostReportForm,
+    HandlePostReportsForm,
     form_for_post,
     form_for_thread,
 )
-from tinyforum.models import Post, PostReport, Thread
+from tinyforum.metrics import instrument, metrics_enabled, prometheus_text, render
+from tinyforum.models import Post, PostReport, ReadMarker, Thread
+from tinyforum.search import post_matches, thread_matches
 from tinyforum.utils import paginate_list, render_detail, render_list
 
 
+def _modified_at(request, pk=None):
+    # Only anonymous pages are the same for everyone
+    if request.user.is_authenticated:
+        return None
+    if not hasattr(request, "_tinyforum_modified_at"):
+        threads = Thread.objects.all() if pk is None else Thread.objects.filter(pk=pk)
+        request._tinyforum_modified_at = threads.aggregate(Max("modified_at"))[
+            "modified_at__max"
+        ]
+    return request._tinyforum_modified_at
+
+
+def _etag(request, pk=None):
+    modified_at = _modified_at(request, pk)
+    return modified_at.isoformat() if modified_at else None
+
+
+conditional_page = condition(etag_func=_etag, last_modified_func=_modified_at)
+
+
+@instrument("view:thread_list")
+@conditional_page
+@cache_anonymous_page(lambda request: [THREAD_LIST_VERSION_KEY])
 def thread_list(request):
-    queryset = Thread.objects.select_related("authored_by", "latest_post__authored_by")
+    queryset = Thread.objects.select_related("authored_by")
 
     if request.GET.get("status") == "closed":
         queryset = queryset.closed()
     else:
         queryset = queryset.active()
 
-    return render_list(request, queryset, paginate_by=50)
+    # Count before annotating, the annotation would be evaluated for every row
+    count = queryset.count()
+    if request.user.is_authenticated:
+        queryset = queryset.with_unread_count(request.user)
+
+    return render_list(
+        request,
+        queryset,
+        paginate_by=50,
+        keys=("-is_pinned", "-latest_post_at", "-created_at", "-id"),
+        count=count,
+    )
 
 
+@instrument("view:post_list")
+@conditional_page
+@cache_anonymous_page(lambda request, pk: [thread_version_key(pk)])
 def post_list(request, pk):
     thread = get_object_or_404(Thread.objects.visible(), pk=pk)
     form = None
@@ -39,11 +97,16 @@ def post_list(request, pk):
         thread.posts.visible().select_related("authored_by"),
         paginate_by=20,
         orphans=5,
+        keys=("created_at", "id"),
+        count=thread.post_count,
     )
 
     if form is None and posts.paginator.num_pages == posts.number:
         form = form_for_post(request, thread=thread)
 
+    if request.user.is_authenticated:
+        ReadMarker.objects.mark_read(request.user, thread, posts.end_index())
+
     return render(
         request,
         "tinyforum/post_list.html",
@@ -51,6 +114,114 @@ def post_list(request, pk):
     )
 
 
+@instrument("view:search")
+def search(request):
+    query = request.GET.get("q", "")
+    threads = Thread.objects.visible().filter(thread_matches(query))
+    posts = paginate_list(
+        request,
+        Post.objects.visible()
+        .exclude(thread__moderation_status=Thread.HIDDEN)
+        .filter(post_matches(query))
+        .select_related("authored_by", "thread"),
+        paginate_by=20,
+        keys=("-created_at", "-id"),
+    )
+
+    return render(
+        request,
+        "tinyforum/post_search.html",
+        {
+            "query": query,
+            "thread_list": threads.order_by("-latest_post_at")[:10],
+            "object_list": posts,
+            "post_list": posts,
+        },
+    )
+
+
+def _parse_since(value):
+    since = parse_datetime(value or "")
+    if since is None:
+        return None
+    elif settings.USE_TZ and timezone.is_naive(since):
+        return timezone.make_aware(since)
+    elif not settings.USE_TZ and timezone.is_aware(since):
+        return timezone.make_naive(since)
+    return since
+
+
+@instrument("view:post_sync")
+def post_sync(request, pk):
+    """
+    Return visible posts of a thread after the post ID ``after`` or the
+    timestamp ``since`` as JSON
+
+    Checking for changes only reads the thread's denormalized latest post.
+    ``wait`` keeps checking for up to ``TINYFORUM_SYNC_MAX_WAIT`` seconds
+    until new posts arrive. Waiting occupies a thread, the default of 0
+    disables it. Only enable it for ASGI deployments using
+    ``tinyforum.async_views.post_sync``; WSGI deployments should stream
+    events using ``tinyforum.live`` instead.
+    """
+    try:
+        after = int(request.GET.get("after") or 0)
+        since = _parse_since(request.GET.get("since"))
+        wait = float(request.GET.get("wait") or 0)
+        if not math.isfinite(wait):
+            raise ValueError("wait must be finite")
+        wait = max(0, min(wait, getattr(settings, "TINYFORUM_SYNC_MAX_WAIT", 0)))
+    except ValueError:
+        return JsonResponse({"error": "invalid parameters"}, status=400)
+
+    deadline = time.monotonic() + wait
+    while True:
+        latest = (
+            Thread.objects.visible()
+            .filter(pk=pk)
+            .values_list("latest_post", "latest_post_at")
+            .first()
+        )
+        if latest is None:
+            raise Http404
+        latest_post, latest_post_at = latest
+        if since:
+            changed = latest_post_at > since
+        else:
+            changed = latest_post is not None and latest_post > after
+        if changed or time.monotonic() >= deadline:
+            break
+        time.sleep(getattr(settings, "TINYFORUM_SYNC_INTERVAL", 1))
+
+    posts = []
+    if changed:
+        queryset = Post.objects.visible().filter(thread=pk)
+        if since:
+            queryset = queryset.filter(created_at__gt=since)
+        else:
+            queryset = queryset.filter(pk__gt=after)
+        # Ordered by the key of the "after" cursor, so that truncated
+        # responses continue where they stopped
+        posts = list(queryset.select_related("authored_by").order_by("id")[:100])
+
+    return JsonResponse(
+        {
+            "thread": int(pk),
+            "posts": [
+                {
+                    "id": post.pk,
+                    "author": str(post.authored_by),
+                    "created_at": post.created_at,
+                    "text": post.text,
+                }
+                for post in posts
+            ],
+            "after": posts[-1].pk if posts else after,
+        }
+    )
+
+
+@instrument("view:thread_form")
 def thread_form(request, *, pk=None, is_moderator=False):
     instance = pk and get_object_or_404(Thread, pk=pk)
     form = form_for_thread(request, instance=instance, is_moderator=is_moderator)
@@ -76,6 +247,7 @@ def thread_form(request, *, pk=None, is_moderator=False):
     )
 
 
+@instrument("view:thread_star")
 def thread_star(request, pk):
     if not request.user.is_authenticated:
         return JsonResponse({"error": "not authenticated"}, status=403)
@@ -87,10 +259,12 @@ def thread_star(request, pk):
         instance.starred_by.add(request.user)
     else:
         instance.starred_by.remove(request.user)
+    set_thread_starred(request.user, instance.pk, status)
 
     return JsonResponse({"thread": instance.pk, "status": int(status)})
 
 
+@instrument("view:post_form")
 def post_form(request, *, pk, is_moderator=False):
     instance = get_object_or_404(Post.objects.select_related("thread"), pk=pk)
     form = form_for_post(
@@ -116,6 +290,7 @@ def post_form(request, *, pk, is_moderator=False):
     )
 
 
+@instrument("view:post_report")
 def post_report(request, *, pk):
     instance = get_object_or_404(Post, pk=pk)
     if instance.reports.filter(authored_by=request.user).exists():
@@ -143,23 +318,40 @@ def post_report(request, *, pk):
     )
 
 
+@instrument("view:report_list")
 def report_list(request):
     return render_list(
         request,
-        PostReport.objects.filter(handled_at__isnull=True)
-        .exclude(authored_by=request.user)
+        PostReport.objects.available(request.user)
         .order_by("created_at")
-        .select_related("post__authored_by", "authored_by"),
+        .select_related("post__authored_by", "post__thread", "authored_by"),
     )
 
 
-def report_handle(request, *, pk):
-    instance = get_object_or_404(
-        PostReport.objects.filter(handled_at__isnull=True).exclude(
-            authored_by=request.user
-        ),
-        pk=pk,
+@instrument("view:report_claim")
+def report_claim(request):
+    if request.method == "POST":
+        if "release" in request.POST:
+            PostReport.objects.release(request.user)
+            return redirect("tinyforum:report-list")
+        PostReport.objects.claim(request.user)
+        return redirect("tinyforum:report-claim")
+
+    reports = list(
+        PostReport.objects.claimed(request.user)
+        .order_by("created_at", "id")
+        .select_related("post__authored_by", "post__thread", "authored_by")
+    )
+    return render(
+        request,
+        "tinyforum/postreport_list.html",
+        {"object_list": reports, "postreport_list": reports, "is_claim": True},
     )
+
+
+@instrument("view:report_handle")
+def report_handle(request, *, pk):
+    instance = get_object_or_404(PostReport.objects.available(request.user), pk=pk)
     kw = {"request": request, "instance": instance}
     if request.method == "POST":
         form = HandlePostReportForm(request.POST, **kw)
@@ -171,3 +363,95 @@ def report_handle(request, *, pk):
     return render(
         request, "tinyforum/report_form.html", {"post": instance, "form": form}
     )
+
+
+@instrument("view:report_bulk_handle")
+@require_POST
+def report_bulk_handle(request):
+    form = BulkHandlePostReportForm(request.POST, request=request)
+    if form.is_valid():
+        reports = form.save()
+        messages.success(request, _("%s reports have been handled.") % len(reports))
+    else:
+        messages.error(request, _("Please select reports and an action."))
+    return redirect("tinyforum:report-list")
+
+
+@instrument("view:report_queue")
+def report_queue(request):
+    posts = paginate_list(
+        request,
+        Post.objects.reported(user=request.user).select_related(
+            "authored_by", "thread"
+        ),
+        paginate_by=20,
+        keys=("id",),
+    )
+    for post in posts:
+        post.report_reasons = [
+            (label, getattr(post, "report_count_%s" % reason))
+            for reason, label in PostReport.REASON_CHOICES
+            if getattr(post, "report_count_%s" % reason)
+        ]
+    return render(
+        request,
+        "tinyforum/postreport_queue.html",
+        {"object_list": posts, "post_list": posts},
+    )
+
+
+@instrument("view:report_post_handle")
+@require_POST
+def report_post_handle(request, *, pk):
+    instance = get_object_or_404(Post, pk=pk)
+    form = HandlePostReportsForm(request.POST, request=request, post=instance)
+    if form.is_valid():
+        reports = form.save()
+        messages.success(request, _("%s reports have been handled.") % len(reports))
+    else:
+        messages.error(request, _("Please select an action."))
+    return redirect("tinyforum:report-queue")
+
+
+def _export(request, records, filename):
+    if request.GET.get("format") == "jsonl":
+        response = StreamingHttpResponse(
+            jsonl(records), content_type="application/x-ndjson"
+        )
+        filename += ".jsonl"
+    else:
+        response = StreamingHttpResponse(
+            zipped(jsonl(records)), content_type="application/zip"
+        )
+        filename += ".zip"
+    response["Content-Disposition"] = 'attachment; filename="%s"' % filename
+    return response
+
+
+def export(request):
+    return _export(request, export_records(request.user), "forum-%s" % request.user.pk)
+
+
+def export_forum(request):
+    return _export(request, export_records(), "forum")
+
+
+def metrics(request):
+    """
+    Return the metrics of the process in the Prometheus text format
+
+    Only available if ``TINYFORUM_METRICS`` is enabled, to staff users or
+    to scrapers sending ``Authorization: Bearer <TINYFORUM_METRICS_TOKEN>``.
+    """
+    if not metrics_enabled():
+        raise Http404
+    token = getattr(settings, "TINYFORUM_METRICS_TOKEN", "")
+    authorization = request.META.get("HTTP_AUTHORIZATION", "")
+    if (
+        not (token and constant_time_compare(authorization, "Bearer %s" % token))
+        and not request.user.is_staff
+    ):
+        raise PermissionDenied
+    return HttpResponse(
+        prometheus_text(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )